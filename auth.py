@@ -1,9 +1,73 @@
 #!/usr/bin/env python
 
+import time
 import redis
 import random
 import hashlib
+import metrics
+import storage
 import settings
+import threading
+import collections
+
+
+class SessionCache(object):
+    """LRU of (session expiry, user level) per username, kept in sync over pub/sub.
+
+    One per process, from shared(), so a reload of this module keeps the
+    cache and its listener thread rather than starting another.
+    """
+
+    def __init__(self, max_size=1024, max_age=60):
+        self.max_size = max_size
+        self.max_age = max_age
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.listener = None
+
+    def start_listener(self, channel):
+        with self.lock:
+            if self.listener is None:
+                self.listener = threading.Thread(target=self.listen, args=(channel,))
+                self.listener.daemon = True
+                self.listener.start()
+
+    def listen(self, channel):
+        while True:
+            try:
+                pubsub = storage.pubsub()
+                pubsub.subscribe(channel)
+                # anything cached before the subscription may have missed a write
+                self.clear()
+                for message in pubsub.listen():
+                    if message['type'] == 'message':
+                        self.invalidate(message['data'])
+            except redis.RedisError:
+                self.clear()
+                time.sleep(1)
+
+    def get(self, username):
+        with self.lock:
+            entry = self.entries.pop(username, None)
+            if entry is None or entry[0] < time.time():
+                return None
+            self.entries[username] = entry
+            return entry[1:]
+
+    def put(self, username, session_expires, user_level):
+        with self.lock:
+            self.entries.pop(username, None)
+            self.entries[username] = (time.time() + self.max_age, session_expires, user_level)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, username):
+        with self.lock:
+            self.entries.pop(username, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
 
 
 class SessionManager(object):
@@ -13,12 +77,46 @@ class SessionManager(object):
     GOD_USER = 10
     TRUSTED_USER = 5
     BASIC_USER = 1
+    UNTRUSTED_LIMIT = 2000
+    UNTRUSTED_TIME_LIMIT = 10
     KEY_TEMPLATE = '{prefix}:{class_seg}:{child_type}:{username}'
+    LEGACY_FIELDS = ('password', 'session', 'challenge', 'user_level')
 
-    r = redis.Redis()
+    r = storage.client
 
     def __init__(self, username):
         self.username = username
+        self._fields = None
+
+    @classmethod
+    def invalidate_channel(cls):
+        return '{}:{}:invalidate'.format(settings.redis_prefix, cls.REDIS_SEG)
+
+    def cached(self):
+        cache = shared()
+        entry = cache.get(self.username)
+        if entry is None:
+            cache.start_listener(self.invalidate_channel())
+            fields = self.fields()
+            entry = (float(fields.get('session_expires', 0)), int(fields.get('user_level', 0)))
+            cache.put(self.username, *entry)
+        return entry
+
+    def invalidate(self):
+        shared().invalidate(self.username)
+        with storage.deferred() as pipe:
+            pipe.publish(self.invalidate_channel(), self.username)
+
+    def fields(self):
+        # one read per instance, and BotCommand makes one instance per message
+        if self._fields is None:
+            self._fields = self.r.hgetall(self.user_key)
+        return self._fields
+
+    def write(self, mapping):
+        self.fields().update(mapping)
+        with storage.deferred() as pipe:
+            pipe.hmset(self.user_key, mapping)
 
     def key(self, child_type):
         return self.KEY_TEMPLATE.format(
@@ -29,31 +127,19 @@ class SessionManager(object):
         )
 
     @property
-    def password_key(self):
-        return self.key('password')
-
-    @property
-    def session_key(self):
-        return self.key('session')
-
-    @property
-    def challenge_key(self):
-        return self.key('challenge')
-
-    @property
-    def user_level_key(self):
-        return self.key('user_level')
+    def user_key(self):
+        return self.key('user')
 
     @property
     def password(self):
-        return self.r.get(self.password_key)
+        return self.fields().get('password')
 
     @password.setter
     def password(self, value):
-        return self.r.set(self.password_key, value)
+        self.write({'password': value})
 
     @property
-    def ouput_limit(self):
+    def output_limit(self):
         out = self.UNTRUSTED_LIMIT
         ul = self.user_level
         if ul > 0:
@@ -62,56 +148,127 @@ class SessionManager(object):
             out = 12000
         return out
 
+    @property
+    def time_limit(self):
+        out = self.UNTRUSTED_TIME_LIMIT
+        ul = self.user_level
+        if ul >= 5:
+            out = self.UNTRUSTED_TIME_LIMIT * 3
+        if ul >= 10:
+            out = 120
+        return out
+
     def challenge(self):
-        challenge = self.r.get(self.challenge_key)
-        if challenge:
-            return challenge
+        now = time.time()
+        fields = self.fields()
+        if fields.get('challenge') and float(fields.get('challenge_expires', 0)) > now:
+            return fields['challenge']
         challenge = hashlib.md5(str(random.random())).hexdigest()
-        if not self.password:
-            answer = None
-        else:
-            answer = hashlib.md5('{}{}\n'.format(challenge, self.password)).hexdigest()
-        self.r.setex(self.challenge_key, answer, self.CHALLENGE_TIMEOUT)
+        answer = ''
+        if fields.get('password'):
+            answer = hashlib.md5('{}{}\n'.format(challenge, fields['password'])).hexdigest()
+        self.write({
+            'challenge': challenge,
+            'answer': answer,
+            'challenge_expires': now + self.CHALLENGE_TIMEOUT,
+        })
         return challenge
 
     def challenge_ttl(self):
-        ttl = self.r.ttl(self.challenge_key)
-        if not ttl:
-            return 0
-        return int(ttl)
+        return max(0, int(float(self.fields().get('challenge_expires', 0)) - time.time()))
 
     def attempt(self, guess):
-        answer = self.r.get(self.challenge_key)
-        if answer == guess:
+        fields = self.fields()
+        if fields.get('answer') and fields['answer'] == guess and float(fields.get('challenge_expires', 0)) > time.time():
+            for field in ('challenge', 'answer', 'challenge_expires'):
+                fields.pop(field, None)
+            with storage.deferred() as pipe:
+                pipe.hdel(self.user_key, 'challenge', 'answer', 'challenge_expires')
             return self.create_session()
         return 0
 
     def create_session(self):
-        self.r.setex(self.session_key, 1, self.SESSION_TIMEOUT)
+        self.write({'session_expires': time.time() + self.SESSION_TIMEOUT})
+        self.invalidate()
         return self.SESSION_TIMEOUT
 
     def has_session(self):
-        ttl = self.r.ttl(self.session_key)
-        if not ttl or ttl == -2:
-            return 0
-        return int(ttl)
+        session_expires = self.cached()[0]
+        return max(0, int(session_expires - time.time()))
 
     def destroy_session(self):
-        return bool(self.r.delete(self.session_key))
+        session_expires = self.fields().pop('session_expires', 0)
+        with storage.deferred() as pipe:
+            pipe.hdel(self.user_key, 'session_expires')
+        self.invalidate()
+        return float(session_expires) > time.time()
 
     @property
     def user_level(self):
-        return int(self.r.get(self.user_level_key))
+        return self.cached()[1]
 
     @user_level.setter
     def user_level(self, value):
-        self.r.set(self.user_level_key, value)
+        self.write({'user_level': value})
+        self.invalidate()
+
+    @classmethod
+    def migrate(cls, batch_size=500):
+        """Fold the old one-string-per-field keys into the per-user hashes."""
+        prefix = cls.KEY_TEMPLATE.format(
+            prefix=settings.redis_prefix,
+            class_seg=cls.REDIS_SEG,
+            child_type='',
+            username='',
+        )[:-1]
+        migrated = 0
+        cursor = 0
+        while True:
+            cursor, keys = cls.r.scan(cursor, match='{}*:*'.format(prefix), count=batch_size)
+            keys = [k for k in keys if k[len(prefix):].split(':', 1)[0] in cls.LEGACY_FIELDS]
+            pipe = cls.r.pipeline(transaction=False)
+            for key in keys:
+                pipe.get(key)
+                pipe.ttl(key)
+            values = pipe.execute()
+            now = time.time()
+            for key, value, ttl in zip(keys, values[::2], values[1::2]):
+                child_type, username = key[len(prefix):].split(':', 1)
+                user_key = cls(username).user_key
+                if child_type == 'session':
+                    if ttl and ttl > 0:
+                        pipe.hset(user_key, 'session_expires', now + ttl)
+                elif child_type != 'challenge' and value is not None:
+                    # old challenges only stored the answer, so they are dropped
+                    pipe.hset(user_key, child_type, value)
+                pipe.delete(key)
+            pipe.execute()
+            migrated += len(keys)
+            if not cursor:
+                return migrated
+
+
+_shared = None
+_shared_lock = threading.Lock()
+
+
+def shared():
+    global _shared
+    with _shared_lock:
+        if _shared is None:
+            _shared = SessionCache(
+                max_size=getattr(settings, 'auth_cache_size', 1024),
+                max_age=getattr(settings, 'auth_cache_ttl', 60),
+            )
+        return _shared
 
 
 def requires_login(user_level=SessionManager.TRUSTED_USER):
     def decorator(func):
         def wrapper(*args, **kwargs):
-            if args[0].session.has_session() and args[0].session.user_level >= user_level:
+            with metrics.timed('auth'):
+                allowed = args[0].session.has_session() and args[0].session.user_level >= user_level
+            if allowed:
                 return func(*args, **kwargs)
             return 'Requires login, and user_level {}'.format(user_level)
         wrapper.__name__ = func.__name__
@@ -121,6 +278,9 @@ def requires_login(user_level=SessionManager.TRUSTED_USER):
 
 if __name__ == '__main__':
     import sys
+    if sys.argv[1] == 'migrate':
+        print 'Migrated {} keys.'.format(SessionManager.migrate())
+        sys.exit()
     username = sys.argv[1]
     sm = SessionManager(username)
     if len(sys.argv) == 3:
@@ -0,0 +1,416 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import time
+import random
+
+BENCHMARKS = {}
+WORDS = ['lorem', 'ipsum', 'dolor', 'sit', 'amet', 'consectetur', 'adipiscing', 'elit', 'sed', 'do']
+WORDS_UTF8 = [u'\xfcber', u'na\xefve', u'\u65e5\u672c\u8a9e', u'\u0436\u0443\u0440\u043d\u0430\u043b', u'caf\xe9', u'\U0001f600']
+
+
+def benchmark(func):
+    BENCHMARKS[func.__name__[len('bench_'):]] = func
+    return func
+
+
+def timed(func, *args, **kwargs):
+    start = time.time()
+    result = func(*args, **kwargs)
+    return result, time.time() - start
+
+
+class FakeConversation(object):
+    def __init__(self):
+        self.sent = []
+
+    def sendText(self, text):
+        self.sent.append(text)
+
+
+class FakeAccount(object):
+    accountName = 'bench'
+
+
+class FakeGroup(object):
+    account = FakeAccount()
+
+    def __init__(self, name):
+        self.name = name
+
+
+class Silenced(object):
+    def __enter__(self):
+        self.stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+
+    def __exit__(self, *exc_info):
+        sys.stdout.close()
+        sys.stdout = self.stdout
+
+
+def start_reactor():
+    import threading
+    from twisted.internet import reactor
+    if not reactor.running:
+        thread = threading.Thread(target=reactor.run, kwargs={'installSignalHandlers': False})
+        thread.daemon = True
+        thread.start()
+        while not reactor.running:
+            time.sleep(0.01)
+
+
+def prose(words, size, line_words=(5, 80)):
+    rand = random.Random(size)
+    lines = []
+    total = 0
+    while total < size:
+        line = u' '.join(rand.choice(words) for _ in xrange(rand.randint(*line_words)))
+        lines.append(line)
+        total += len(line) + 1
+    return u'\n'.join(lines).encode('utf-8')
+
+
+@benchmark
+def bench_packer():
+    import packer
+    import botcommand
+    budget = packer.budget('#zonkb0t')
+    # (name, text, whether pack must send fewer messages); short lines like ps output
+    # are never joined, so they go out one message each either way
+    corpora = (
+        ('prose', prose(WORDS, 2 * 2 ** 20), True),
+        ('utf8', prose(WORDS_UTF8, 2 * 2 ** 20), True),
+        ('one_line', prose(WORDS, 4 * 2 ** 20, line_words=(10 ** 6, 10 ** 6)), True),
+        ('ps', '\n'.join('psutil.Process(pid={}, name=\'worker\')'.format(i) for i in xrange(20000)), False),
+    )
+    print 'budget {} bytes'.format(budget)
+    for name, text, fewer in corpora:
+        old, old_time = timed(lambda: [c for l in text.split('\n') for c in botcommand.n_at_a_time(l, 120)])
+        new, new_time = timed(lambda: list(packer.pack(text, budget)))
+        assert all(len(chunk) <= budget for chunk in new)
+        for chunk in new:
+            chunk.decode('utf-8')
+        assert len(new) < len(old) if fewer else len(new) <= len(old), name
+        print '{:10} {:>9} bytes  n_at_a_time: {:>7} msgs {:7.3f}s  pack: {:>7} msgs {:7.3f}s  ({:.1f}x fewer)'.format(
+            name, len(text), len(old), old_time, len(new), new_time, len(old) / float(len(new)),
+        )
+
+
+@benchmark
+def bench_roundtrips():
+    import auth
+    import storage
+    import botcommand
+    conversation = FakeConversation()
+    username = 'bench-roundtrips'
+    lines = (
+        '%login',
+        '%login',
+        '%usage',
+        '%list add bench-roundtrips a b c',
+        '%list show bench-roundtrips',
+        '%list random bench-roundtrips',
+    )
+    auth.shared().invalidate(username)
+    for text in lines:
+        bc = botcommand.BotCommand(conversation, username, text, groupname='#bench')
+        name = bc.command_name
+        before = storage.stats[name][1]
+        bc._execute()
+        print '{:40} {} round trips'.format(text, storage.stats[name][1] - before)
+    storage.client.delete(auth.SessionManager(username).user_key, bc._list_key('bench-roundtrips'))
+
+
+@benchmark
+def bench_dispatch():
+    import bot
+    import logger
+    import settings
+    import botcommand
+    count = 100000
+    lines = [('nick{}'.format(i % 50), ' '.join(WORDS[i % 7:])) for i in xrange(count)]
+    conversation = bot.MinGroupConversation(FakeGroup('#bench'), bot.MinChat())
+
+    def construct_every_line():
+        # what showGroupMessage did for every line before the fast path
+        for sender, text in lines:
+            logger.log(
+                ('<', sender, '/', '#bench', '> ', text),
+                (None, settings.cd['n'], None, settings.cd['c'], None, settings.cd['cm']),
+            )
+            botcommand.BotCommand(conversation, sender, text, groupname='#bench')
+
+    def fast_path():
+        for sender, text in lines:
+            conversation.showGroupMessage(sender, text)
+
+    for name, func in (('log + BotCommand', construct_every_line), ('showGroupMessage', fast_path)):
+        with Silenced():
+            _, elapsed = timed(func)
+        print '{:20} {:>10.0f} lines/s'.format(name, count / elapsed)
+
+
+class StandInServer(object):
+    """Local pages: huge, slow, og:title only, not html at all, and slow to answer."""
+
+    def __init__(self):
+        import BaseHTTPServer
+        head = '<html><head><meta charset="utf-8"><title>Stand-in &amp; friends</title></head><body>'
+        filler = '<p>{}</p>\n'.format(' '.join(WORDS) * 20)
+        pages = {
+            # path: (content type, start of body, filler, size, delay per 16KB, delay before answering)
+            '/huge': ('text/html', head, filler, 4 * 2 ** 20, 0, 0),
+            '/slow': ('text/html', head, filler, 2 ** 16, 0.25, 0),
+            '/og': ('text/html', '<html><head><meta property="og:title" content="Only og"></head><body>', filler, 2 ** 20, 0, 0),
+            '/image': ('image/png', '', 'x' * 8192, 4 * 2 ** 20, 0, 0),
+            '/delayed': ('application/json', '{"ok": true}', ' ', 12, 0, 0.5),
+        }
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                content_type, start, chunk, size, delay, wait = pages[self.path.split('?')[0]]
+                time.sleep(wait)
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(size))
+                self.end_headers()
+                body = start + chunk * (size // len(chunk) + 1)
+                try:
+                    for offset in xrange(0, size, 2 ** 14):
+                        self.wfile.write(body[offset:min(size, offset + 2 ** 14)])
+                        if delay:
+                            self.wfile.flush()
+                            time.sleep(delay)
+                except Exception:
+                    pass
+
+            def log_message(self, *args):
+                pass
+
+        import SocketServer
+        import threading
+
+        class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+            daemon_threads = True
+
+            def handle_error(self, request, client_address):
+                # clients hanging up early is the point
+                pass
+
+        self.server = Server(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.base = 'http://127.0.0.1:{}'.format(self.server.server_address[1])
+
+
+@benchmark
+def bench_title():
+    import fetch
+    import urllib2
+    import webclient
+    import BeautifulSoup
+    start_reactor()
+    stand_in = StandInServer()
+
+    def full_parse(url):
+        # what %url did before: read the whole body and build the whole tree
+        return BeautifulSoup.BeautifulSoup(urllib2.urlopen(url).read()).title
+
+    for path in ('/huge', '/slow', '/og', '/image'):
+        url = stand_in.base + path
+        request = {'url': url, 'parser': fetch.TitleParser(), 'max_bytes': fetch.TITLE_MAX_BYTES}
+        (response,), new_time = timed(webclient.fetch_many, [request])
+        _, old_time = timed(full_parse, url)
+        title = response.parser.title or response.parser.mime
+        print '{:7} streamed: {:7.3f}s  full parse: {:7.3f}s  -> {!r}'.format(path, new_time, old_time, title)
+
+
+@benchmark
+def bench_fanout():
+    import webclient
+    start_reactor()
+    stand_in = StandInServer()
+    for count in (1, 4, 8):
+        requests = [{'url': '{}/delayed?{}'.format(stand_in.base, i)} for i in xrange(count)]
+        _, one_by_one = timed(lambda: [webclient.fetch_many([request]) for request in requests])
+        responses, fanned_out = timed(webclient.fetch_many, requests)
+        assert [r.url for r in responses] == [r['url'] for r in requests]
+        print '{} urls, 0.5s each: one by one {:6.2f}s  fanned out {:6.2f}s'.format(count, one_by_one, fanned_out)
+
+
+@benchmark
+def bench_listing():
+    import json
+    import reddit
+    children = [
+        {'kind': 't3', 'data': {'title': 'Post {}'.format(i), 'url': 'http://example.com/{}'.format(i), 'selftext': ' '.join(WORDS) * 40}}
+        for i in xrange(100)
+    ]
+    body = json.dumps({'kind': 'Listing', 'data': {'after': 't3_x', 'children': children}})
+    for limit in (1, 5, 100):
+        def incremental():
+            parser = reddit.ListingParser(limit)
+            for offset in xrange(0, len(body), 4096):
+                parser.feed(body[offset:offset + 4096])
+                if parser.done:
+                    return parser.posts, min(offset + 4096, len(body))
+            return parser.posts, len(body)
+        (posts, read), elapsed = timed(incremental)
+        assert [post.title for post in posts] == ['Post {}'.format(i) for i in xrange(limit)]
+        _, full = timed(json.loads, body)
+        print 'limit {:3}: read {:>7} of {} bytes in {:.4f}s  (json.loads of everything {:.4f}s)'.format(limit, read, len(body), elapsed, full)
+
+
+@benchmark
+def bench_lists():
+    import storage
+    import botcommand
+    from plugins import lists
+    conversation = FakeConversation()
+    name = 'bench-lists'
+    items = ['quote number {}'.format(i) for i in xrange(10000)]
+    bc = botcommand.BotCommand(conversation, 'bench-lists', '%list', groupname='#bench')
+    key = bc._list_key(name)
+    for size in (10000, 100000, 1000000):
+        storage.client.delete(key)
+        for offset in xrange(0, size, len(items)):
+            storage.client.lpush(key, *items)
+        _, old_random = timed(lambda: random.choice(storage.client.lrange(key, 0, -1)))
+        _, new_random = timed(bc._list_random, [name])
+        _, old_show = timed(lambda: storage.client.lrange(key, 0, -1)[::-1][:lists.SHOW_COUNT])
+        _, new_show = timed(bc._list_show, [name])
+        print '{:>7} items  random: lrange {:7.4f}s  llen+lindex {:7.4f}s  show: lrange {:7.4f}s  paged {:7.4f}s'.format(
+            size, old_random, new_random, old_show, new_show)
+    storage.client.delete(key)
+    add = ['item {}'.format(i) for i in xrange(1000)]
+    _, one_by_one = timed(lambda: [storage.client.lpush(key, item) for item in add])
+    storage.client.delete(key)
+    _, variadic = timed(bc._list_add, [name] + add)
+    storage.client.delete(key)
+    print 'add 1000 items: one lpush each {:7.4f}s  one variadic lpush {:7.4f}s'.format(one_by_one, variadic)
+
+
+@benchmark
+def bench_logger():
+    import tempfile
+    import termcolor
+    import logger
+    import settings
+    count = 100000
+    colors = (None, settings.cd['n'], None, settings.cd['c'], None, settings.cd['cm'])
+    lines = [('<', 'nick{}'.format(i % 50), '/', '#bench', '> ', ' '.join(WORDS[i % 7:])) for i in xrange(count)]
+    log_file = tempfile.TemporaryFile()
+
+    def write_and_flush_each():
+        # what log() did before: color, print, write and flush on the caller's thread
+        for strings in lines:
+            out = '[{}] '.format(termcolor.colored(time.strftime('%Y-%m-%d %H:%M:%S'), 'cyan'))
+            for s, c in zip(strings, colors):
+                out += termcolor.colored(s, c[0], **c[1]) if c else s
+            print out
+            log_file.write('{}\n'.format(''.join(strings)))
+            log_file.flush()
+
+    def enqueue():
+        for strings in lines:
+            logger.log(strings, colors)
+
+    with Silenced():
+        _, old = timed(write_and_flush_each)
+        _, callers = timed(enqueue)
+        _, writer = timed(logger._writer.queue.join)
+    print 'write + flush per line {:>9.0f} lines/s'.format(count / old)
+    print 'enqueue for the writer {:>9.0f} lines/s on the calling thread, drained {:.2f}s later'.format(count / callers, writer)
+
+
+@benchmark
+def bench_metrics():
+    import metrics
+    count = 100000
+
+    def bare():
+        for i in xrange(count):
+            pass
+
+    def instrumented():
+        for i in xrange(count):
+            with metrics.command('bench', 0.0001, 0.00001):
+                with metrics.timed('handler'):
+                    metrics.add('redis', 0.0001)
+
+    def outside():
+        for i in xrange(count):
+            with metrics.timed('redis'):
+                pass
+
+    class Empty(object):
+        def __enter__(self):
+            pass
+
+        def __exit__(self, *exc_info):
+            pass
+
+    def floor():
+        # what two nested with blocks cost on this interpreter before any of them does work
+        for i in xrange(count):
+            with Empty():
+                with Empty():
+                    pass
+
+    def best(func):
+        # the fastest of a few runs, so a busy machine doesn't decide the number
+        return min(timed(func)[1] for _ in xrange(3))
+
+    base = best(bare)
+    print 'command + handler timer + one add {:.2f}us per command'.format((best(instrumented) - base) / count * 10 ** 6)
+    print '  of which two empty with blocks {:.2f}us'.format((best(floor) - base) / count * 10 ** 6)
+    print 'redis timer outside a command {:.2f}us per call'.format((best(outside) - base) / count * 10 ** 6)
+
+
+@benchmark
+def bench_startup():
+    import subprocess
+    # a fresh interpreter each time; everything loaded is what importing every plugin up front used to cost
+    probe = (
+        'import time, resource\n'
+        'start = time.time()\n'
+        'import botcommand, plugins\n'
+        'if {}:\n'
+        '    [plugins.module(plugin) for plugin in plugins.names()]\n'
+        'print time.time() - start, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss\n'
+    )
+    for label, everything in (('lazy plugins', False), ('every plugin', True)):
+        runs = []
+        for _ in xrange(5):
+            out = subprocess.check_output([sys.executable, '-c', probe.format(everything)])
+            seconds, rss = out.split()[-2:]
+            runs.append((float(seconds), int(rss)))
+        print 'import botcommand, {:12}  best {:.3f}s  peak rss {} KB'.format(label, min(runs)[0], min(rss for _, rss in runs))
+
+
+@benchmark
+def bench_ps():
+    import psutil
+    import procmon
+    _, walk = timed(lambda: '\n'.join([str(p) for p in psutil.process_iter()]))
+    text = '\n'.join([str(p) for p in psutil.process_iter()])
+    monitor = procmon.ProcessMonitor()
+    _, sample = timed(monitor.sample)
+    snapshot = monitor.sample()
+    count = 1000
+    _, query = timed(lambda: [snapshot.top(10, 'cpu') for _ in xrange(count)])
+    _, filtered = timed(lambda: [snapshot.top(10, 'mem', name='python') for _ in xrange(count)])
+    top = '\n'.join(procmon.line(proc, snapshot.memory) for proc in snapshot.top(10))
+    print '{} processes: walk + str each {:.4f}s for {} bytes of output'.format(snapshot.count, walk, len(text))
+    print 'background sample {:.4f}s; top 10 by cpu {:.1f}us, by mem named python {:.1f}us, {} bytes of output'.format(
+        sample, query / count * 10 ** 6, filtered / count * 10 ** 6, len(top))
+
+
+if __name__ == '__main__':
+    names = sys.argv[1:] or sorted(BENCHMARKS)
+    for name in names:
+        print '== {}'.format(name)
+        BENCHMARKS[name]()
@@ -3,6 +3,8 @@
 from twisted.words.im import basechat, baseaccount
 import auth
 import logger
+import capture
+import metrics
 import settings
 import botcommand
 
@@ -15,19 +17,19 @@ class MinConversation(basechat.Conversation):
         pass
 
     def showMessage(self, text, metadata=None):
+        capture.record('pm', None, self.person.name, text)
+        if not botcommand.is_command(text):
+            logger.chat(self.person.name, None, text)
+            return
         logger.log(
             ('<', self.person.name, '> ', text),
             (None, settings.cd['n'], None, settings.cd['pm']),
         )
         bc = botcommand.BotCommand(self, self.person.name, text)
-        try:
-            bc.execute()
-        except botcommand.ReloadException:
-            self.sendText('Reloading')
-            reload(auth)
-            reload(botcommand)
+        bc.execute()
 
     def contactChangedNick(self, person, newnick):
+        capture.record('nick', None, person.name, newnick)
         logger.log(
             (' -!- ', person.name, ' is now known as ', newnick),
             (settings.cd['a'], settings.cd['n'], None, settings.cd['n']),
@@ -44,41 +46,51 @@ class MinGroupConversation(basechat.GroupConversation):
         pass
 
     def showGroupMessage(self, sender, text, metadata=None):
+        capture.record('msg', self.group.name, sender, text)
+        if not botcommand.is_command(text):
+            logger.chat(sender, self.group.name, text)
+            return
         logger.log(
             ('<', sender, '/', self.group.name, '> ', text),
             (None, settings.cd['n'], None, settings.cd['c'], None, settings.cd['cm']),
+            event=('msg', sender, self.group.name, text),
         )
         bc = botcommand.BotCommand(self, sender, text, groupname=self.group.name)
-        try:
-            bc.execute()
-        except botcommand.ReloadException:
-            reload(botcommand)
+        bc.execute()
 
     def setTopic(self, topic, author):
+        capture.record('topic', self.group.name, author, topic)
         logger.log(
             ('-!- ', author, ' set the ', self.group.name, ' topic to ', topic),
             (settings.cd['a'], settings.cd['n'], None, settings.cd['c'], None, settings.cd['t']),
+            event=('topic', author, self.group.name, topic),
         )
 
     def memberJoined(self, member):
+        capture.record('join', self.group.name, member)
         logger.log(
             ('-!- ', member, ' joined ', self.group.name),
             (settings.cd['a'], settings.cd['n'], None, settings.cd['c']),
+            event=('join', member, self.group.name, ''),
         )
         basechat.GroupConversation.memberJoined(self, member)
 
     def memberChangedNick(self, oldnick, newnick):
+        capture.record('nick', self.group.name, oldnick, newnick)
         logger.log(
             ('-!- ', oldnick, ' in ', self.group.name, ' is now known as ', newnick),
             (settings.cd['a'], settings.cd['n'], None, settings.cd['c'], None, settings.cd['n']),
+            event=('nick', oldnick, self.group.name, newnick),
         )
         auth.SessionManager(oldnick).destroy_session()
         basechat.GroupConversation.memberChangedNick(self, oldnick, newnick)
 
     def memberLeft(self, member):
+        capture.record('leave', self.group.name, member)
         logger.log(
             ('-!- ', member, ' left ', self.group.name),
             (settings.cd['a'], settings.cd['n'], None, settings.cd['c']),
+            event=('leave', member, self.group.name, ''),
         )
         auth.SessionManager(member).destroy_session()
         basechat.GroupConversation.memberLeft(self, member)
@@ -111,5 +123,6 @@ class AccountManager(baseaccount.AccountManager):
 if __name__ == "__main__":
     from twisted.internet import reactor
     AccountManager()
+    reactor.callWhenRunning(metrics.start_dump)
     started = False
     reactor.run()
@@ -1,18 +1,17 @@
+import sys
 import auth
-import json
 import time
-import Queue
-import redis
+import types
 import shlex
 import logger
-import psutil
-import random
+import pager
+import metrics
+import packer
+import plugins
+import executor
+import scheduler
+import storage
 import settings
-import threading
-import subprocess
-import urlgrabber
-import collections
-import BeautifulSoup
 
 
 def n_at_a_time(iterable, n, to_type=None):
@@ -38,6 +37,10 @@ def n_at_a_time(iterable, n, to_type=None):
             break
 
 
+def is_command(text):
+    return text.startswith(BotCommand.CMD_PREFIX)
+
+
 class UsageTracker(object):
     SECOND = 1
     MINUTE = SECOND * 60
@@ -47,35 +50,62 @@ class UsageTracker(object):
     MONTH = DAY * 30
     YEAR = DAY * 365
     REDIS_SEG = 'usage'
-    WINDOW = MONTH
-
-    r = redis.Redis()
+    # (resolution, bucket width, buckets kept)
+    RESOLUTIONS = (
+        ('minute', MINUTE, 60),
+        ('hour', HOUR, 24),
+        ('day', DAY, 30),
+    )
+    # (label, resolution, buckets summed); windows are bucket aligned
+    WINDOWS = (
+        ('Minute', 'minute', 1),
+        ('Hour', 'minute', 60),
+        ('Day', 'hour', 24),
+        ('Week', 'day', 7),
+        ('Month', 'day', 30),
+    )
+
+    r = storage.client
 
     def __init__(self, username):
         self.username = username
 
-    @property
-    def key(self):
-        return '{}:{}:{}'.format(settings.redis_prefix, self.REDIS_SEG, self.username)
+    def key(self, resolution, bucket):
+        return '{}:{}:{}:{}:{}'.format(settings.redis_prefix, self.REDIS_SEG, self.username, resolution, bucket)
 
     def update(self, value):
         t = int(time.time())
-        self.r.zadd(self.key, value, t)
-        self.r.zremrangebyscore(self.key, -1, t - self.WINDOW)
-
-    def sum_range(self, window):
+        with storage.deferred() as pipe:
+            for resolution, width, kept in self.RESOLUTIONS:
+                key = self.key(resolution, t // width)
+                pipe.hincrby(key, 'bytes', value)
+                pipe.hincrby(key, 'commands', 1)
+                pipe.expire(key, width * (kept + 1))
+
+    def totals(self):
         t = int(time.time())
-        return sum([int(v) for v in self.r.zrangebyscore(self.key, t - window, t)])
+        pipe = self.r.pipeline(transaction=False)
+        for resolution, width, kept in self.RESOLUTIONS:
+            current = t // width
+            for bucket in xrange(current - kept + 1, current + 1):
+                pipe.hmget(self.key(resolution, bucket), 'bytes', 'commands')
+        results = iter(pipe.execute())
+        buckets = {}
+        for resolution, width, kept in self.RESOLUTIONS:
+            buckets[resolution] = [
+                (int(b or 0), int(c or 0)) for b, c in (next(results) for _ in xrange(kept))
+            ]
+        totals = []
+        for label, resolution, count in self.WINDOWS:
+            window = buckets[resolution][-count:]
+            totals.append((label, sum(b for b, _ in window), sum(c for _, c in window)))
+        return totals
 
     @property
     def usage(self):
-        return 'Command output of {}: Minute:{}  Hour:{}  Day:{}  Week:{}  Month:{}'.format(
+        return 'Command output (bytes/commands) of {}: {}'.format(
             self.username,
-            self.sum_range(self.MINUTE),
-            self.sum_range(self.HOUR),
-            self.sum_range(self.DAY),
-            self.sum_range(self.WEEK),
-            self.sum_range(self.MONTH),
+            '  '.join('{}:{}/{}'.format(*total) for total in self.totals()),
         )
 
     @classmethod
@@ -84,67 +114,34 @@ class UsageTracker(object):
 
 
 class Throttler(object):
-    DELAY = .5
-    CHUNK_SIZE = 120
-
-    threads = collections.defaultdict(dict)
-
-    def __init__(self, username, groupname, output_function):
+    def __init__(self, username, groupname, output_function, account_name=None):
         self.username = username
         self.groupname = groupname
         self.output_function = output_function
+        self.account_name = account_name
 
     @property
     def key(self):
         return self.groupname if self.groupname else self.username
 
-    def start(self):
-        if not self.threads[self.key].get('started'):
-            self.threads[self.key]['started'] = True
-            thread = threading.Thread(target=self.worker)
-            thread.daemon = True
-            thread.start()
-            self.threads[self.key]['thread'] = thread
-
-    def worker(self):
-        while True:
-            try:
-                output_function, chunk = self.threads[self.key]['queue'].get(block=False)
-                output_function(chunk)
-                time.sleep(self.DELAY)
-            except Queue.Empty:
-                self.threads[self.key]['started'] = False
-                return
+    @property
+    def scheduler(self):
+        return scheduler.for_account(self.account_name)
 
     def enqueue(self, text):
         # text = text[:user_session.output_limit]
         UsageTracker(self.username).update(len(text))
-        if 'queue' not in self.threads[self.key]:
-            self.threads[self.key]['queue'] = Queue.Queue()
-        for line in text.split('\n'):
-            for chunk in n_at_a_time(line, self.CHUNK_SIZE):
-                self.threads[self.key]['queue'].put((self.output_function, chunk))
-        self.start()
+        chunks = list(packer.pack(text, packer.budget(self.key)))
+        self.scheduler.enqueue(self.key, self.output_function, chunks)
 
     def flush(self):
-        t = threading.Thread(target=self._flush)
-        t.daemon = True
-        t.start()
-
-    def _flush(self):
-        while True:
-            try:
-                self.threads[self.key]['queue'].get(block=False)
-            except (Queue.Empty, KeyError):
-                return
-
-
-class ReloadException(Exception):
-    pass
+        self.scheduler.flush(self.key)
 
 
 class BotCommand(object):
     CMD_PREFIX = '%'
+    PRIORITY_COMMANDS = ('_login', '_flush')
+    BUSY_MESSAGE = 'Too busy right now, try again in a bit.'
 
     cmd_map = {
         'alias'       : '_admin',
@@ -152,16 +149,20 @@ class BotCommand(object):
         'dice'        : '_dice',
         'echo'        : '_echo',
         'flush'       : '_flush',
+        'grep'        : '_grep',
         'help'        : '_help',
         'join'        : '_join',
         'leave'       : '_leave',
         'list'        : '_list',
         'login'       : '_login',
+        'more'        : '_more',
         'mysql'       : '_mysql',
         'ps'          : '_ps',
         'reddit'      : '_reddit',
         'reload'      : '_reload',
         'run'         : '_run',
+        'seen'        : '_seen',
+        'stats'       : '_stats',
         'status'      : '_status',
         'stfu'        : '_flush',
         'test'        : '_test',
@@ -170,17 +171,21 @@ class BotCommand(object):
         'weather'     : '_weather',
         'weather_raw' : '_weather_raw',
     }
-    r = redis.Redis()
+    r = storage.client
 
     def __init__(self, calling_class, username, text, groupname=None):
         self.username = username
         self.calling_class = calling_class
         self.groupname = groupname
-        self.session = auth.SessionManager(username)
         self.text = text
         self.args = None
-        self.throttler = Throttler(username, groupname, calling_class.sendText)
-        if self.text and self.text[0] == self.CMD_PREFIX:
+        self._session = None
+        self._throttler = None
+        self._pager = None
+        self.parse_time = 0.0
+        self.submitted = None
+        if is_command(text):
+            start = time.time()
             logger.log(
                 ('-!- COMMAND FROM -!- ', ': ', username),
                 (settings.cd['a'], None, settings.cd['n']),
@@ -193,6 +198,47 @@ class BotCommand(object):
                     (settings.cd['e'], None, settings.cd['e']),
                 )
                 self.args = []
+            self.parse_time = time.time() - start
+
+    def __getattr__(self, name):
+        # handlers not defined here live in plugins, imported the first time they are asked for
+        handler = plugins.handler(name)
+        if handler is None:
+            raise AttributeError(name)
+        return types.MethodType(handler, self)
+
+    @property
+    def session(self):
+        if self._session is None:
+            self._session = auth.SessionManager(self.username)
+        return self._session
+
+    @property
+    def throttler(self):
+        if self._throttler is None:
+            self._throttler = Throttler(self.username, self.groupname, self.calling_class.sendText, self.account_name)
+        return self._throttler
+
+    @property
+    def pager(self):
+        if self._pager is None:
+            self._pager = pager.Pager.for_user(self.username, self.throttler.key)
+        return self._pager
+
+    def output(self, text):
+        """Send text as far as the first page goes; the rest waits for %more."""
+        text = self.pager.write(text)
+        if text:
+            self.throttler.enqueue(text)
+
+    def more_hint(self, pages):
+        return '{} more page{}: `{}more`'.format(pages, 's' if pages != 1 else '', self.CMD_PREFIX)
+
+    @property
+    def account_name(self):
+        target = getattr(self.calling_class, 'group', None) or getattr(self.calling_class, 'person', None)
+        account = getattr(target, 'account', None)
+        return getattr(account, 'accountName', None)
 
     def parse(self, text):
         args = shlex.split(text)
@@ -200,10 +246,28 @@ class BotCommand(object):
             return []
         return args
 
+    @property
+    def command_name(self):
+        if not self.args:
+            return None
+        if len(self.args[0]) == len(self.CMD_PREFIX):
+            return self.args[1] if len(self.args) > 1 else None
+        return self.args[0].lstrip(self.CMD_PREFIX)
+
     def execute(self):
-        t = threading.Thread(target=self._execute)
-        t.daemon = True
-        t.start()
+        if not self.args:
+            return
+        priority = executor.CommandExecutor.NORMAL
+        if self.cmd_map.get(self.command_name) in self.PRIORITY_COMMANDS:
+            priority = executor.CommandExecutor.HIGH
+        owner = (self.groupname, self.username)
+        self.submitted = time.time()
+        if not executor.shared().submit(owner, self._execute, priority):
+            logger.log(
+                ('-!- COMMAND REJECTED -!- ', ': ', self.username),
+                (settings.cd['e'], None, settings.cd['n']),
+            )
+            self.throttler.enqueue(self.BUSY_MESSAGE)
 
     def _execute(self):
         if not self.args:
@@ -215,19 +279,30 @@ class BotCommand(object):
             # trim
             self.args[0] = self.args[0].lstrip(self.CMD_PREFIX)
         cmd_name = self.args.pop(0)
-        if cmd_name in self.cmd_map and hasattr(self, self.cmd_map[cmd_name]):
-            output = getattr(self, self.cmd_map[cmd_name])(self.args)
-            if output is not None:
-                logger.log(
-                    ('-!- COMMAND OUTPUT -!- ', ': ', output),
-                    (settings.cd['a'], None, settings.cd['cm']),
-                )
-                self.throttler.enqueue(str(output))
-            else:
-                logger.log(
-                    ('-!- COMMAND FAILED -!- ',),
-                    (settings.cd['a'],),
-                )
+        # getattr rather than hasattr, so a plugin that fails to import says why
+        handler = getattr(self, self.cmd_map[cmd_name], None) if cmd_name in self.cmd_map else None
+        if handler is not None:
+            queued = time.time() - self.submitted if self.submitted else 0.0
+            with metrics.command(cmd_name, queued, self.parse_time), storage.request(cmd_name):
+                with metrics.timed('handler'):
+                    output = handler(self.args)
+                if output is not None:
+                    logger.log(
+                        ('-!- COMMAND OUTPUT -!- ', ': ', output),
+                        (settings.cd['a'], None, settings.cd['cm']),
+                    )
+                    self.output(str(output))
+                    pages = self.pager.close()
+                    if pages:
+                        hint = self.more_hint(pages)
+                        if self.pager.dropped:
+                            hint += ' (output truncated)'
+                        self.throttler.enqueue(hint)
+                else:
+                    logger.log(
+                        ('-!- COMMAND FAILED -!- ',),
+                        (settings.cd['a'],),
+                    )
         else:
             logger.log(
                 ('-!- UNREGISTERED COMMAND -!- ', ': ', cmd_name),
@@ -258,125 +333,6 @@ class BotCommand(object):
         if len(args) == 1 and args[0] == 'show':
             return '\n'.join(['{} = {}'.format(cmd, val) for cmd, val in self.cmd_map.iteritems()])
 
-    #### LIST
-    def _list(self, args):
-        """Usage: `{cmd_prefix}list [add|show|random|del] list_name`"""
-        output = ""
-        list_map = {
-            'add'    : '_list_add',
-            'show'   : '_list_show',
-            'random' : '_list_random',
-            'del'    : '_list_del',
-        }
-
-        if not args:
-            return None
-
-        list_cmd = args.pop(0)
-        if list_cmd in list_map and hasattr(self, list_map[list_cmd]):
-            output = getattr(self, list_map[list_cmd])(args)
-        return output
-
-    def _list_add(self, args):
-        if not args:
-            return None
-        name = args.pop(0)
-        did = False
-        for arg in args:
-            did = self.r.lpush(self._list_key(name), arg)
-        return str(did)
-
-    def _list_show(self, args):
-        if not args:
-            return None
-        output = []
-        for name in args:
-            output.extend(self.r.lrange(self._list_key(name), 0, -1)[::-1])
-        return str(output)
-
-    def _list_random(self, args):
-        if not args:
-            return None
-        output = []
-        for name in args:
-            choose_from = self.r.lrange(self._list_key(name), 0, -1)
-            output.append(choose_from[random.randint(0, len(choose_from) - 1)])
-        if len(output) == 1:
-            return str(output[0])
-        return str(output)
-
-    def _list_del(self, args):
-        if not args:
-            return None
-        output = []
-        for name in args:
-            output.append(self.r.delete(self._list_key(name)))
-        if len(output) == 1:
-            return str(output[0])
-        return str(output)
-
-    def _list_key(self, name):
-        return '{}:{}:{}'.format(settings.redis_prefix, 'list', name)
-
-    #### DICE
-    def _dice(self, args):
-        """Usage: `{cmd_prefix}dice *args` with args in the form of (number)[dD](sides) -- 1D6 is default"""
-        if not args:
-            args = ['1d6']
-        output = []
-        for roll in args:
-            roll = roll.lower().replace(' ', '')
-            roll_output = {
-                'group' : roll,
-                'rolls' : [],
-                'sum'   : 0,
-            }
-            groups = [i for i in roll.split('+')]
-            for group in groups:
-                group_rolls = self._dice_roll(group)
-                roll_output['rolls'].append(group_rolls)
-                roll_output['sum'] = sum(sum(i) for i in roll_output['rolls'])
-            output.append(roll_output)
-        if len(output) == 1:
-            return 'group {group} had sum {sum} with rolls {rolls}'.format(**output[0])
-        return '\n'.join('group {group} had sum {sum} with rolls {rolls}'.format(**i) for i in output)
-
-    def _dice_roll(self, roll):
-        roll_parts = roll.split('d')
-        if not roll_parts:
-            return None
-        if len(roll_parts) == 1:
-            return [int(roll_parts[0])]
-        if len(roll_parts) == 2 and not roll_parts[0]:
-            roll_parts[0] = 1
-        if len(roll_parts) == 2 and not roll_parts[1]:
-            roll_parts[1] = 6
-        return [random.randint(1, int(roll_parts[1])) for i in range(int(roll_parts[0]))]
-
-    #### RUN
-    @auth.requires_login(user_level=auth.SessionManager.GOD_USER)
-    def _run(self, args):
-        """Usage: `{cmd_prefix}run cmd`"""
-        if not args:
-            return None
-        try:
-            return subprocess.check_output(args)
-        except subprocess.CalledProcessError:
-            return 'Command exited with error.'
-
-    #### URL
-    def _url(self, args):
-        """Usage: `{cmd_prefix}url *urls`"""
-        if not args:
-            return None
-        output = []
-        for url in args:
-            if not any(url.startswith(i) for i in ('https://', 'http://')):
-                url = 'http://{}'.format(url)
-            bs = BeautifulSoup.BeautifulSoup(urlgrabber.urlread(url, size=2097152*10))
-            output.append(bs.title.string)
-        return '\n'.join(output)
-
     #### ECHO
     def _echo(self, args):
         """Usage: `{cmd_prefix}echo text`"""
@@ -418,29 +374,34 @@ class BotCommand(object):
         else:
             return 'Attempt failed. Challenge ttl is {} seconds.'.format(self.session.challenge_ttl())
 
-    #### REDIT
-    def _reddit(self, args):
-        """Usage: `{cmd_prefix}reddit [*subreddits]`"""
-        output = []
-        args = args if args else ['']
-        for arg in args:
-            if arg:
-                site = 'http://www.reddit.com/r/{}'.format(arg)
-                logger.log((site, ), (None, ))
-            else:
-                site = 'http://www.reddit.com/'
-            bs = BeautifulSoup.BeautifulSOAP(urlgrabber.urlread(site, size=2097152*10))
-            output.extend(bs.findAll('a', 'title'))
-        return '\n'.join('{}: {} {}'.format(i + 1, o.string, o.get('href')) for i, o in enumerate(output[:5]))
-
     #### RELOAD
     @auth.requires_login(user_level=auth.SessionManager.GOD_USER)
     def _reload(self, args):
-        """Usage: `{cmd_prefix}reload`"""
-        reload(auth)
-        reload(logger)
-        reload(settings)
-        raise ReloadException
+        """Usage: `{cmd_prefix}reload [settings|auth|logger|plugin|command ...]` -- all but the plugins not yet loaded by default"""
+        output = []
+        for name in args or ['settings', 'auth', 'logger'] + plugins.loaded():
+            if name == 'settings':
+                accounts = getattr(settings, 'accounts', [])
+                reload(settings)
+                # keep the connected accounts; the reloaded ones were never logged on
+                settings.accounts = accounts
+                output.append('Reloaded settings.')
+                continue
+            if name in ('auth', 'logger'):
+                plugins.reload_module(sys.modules[name])
+                output.append('Reloaded {}.'.format(name))
+                continue
+            plugin = name if name in plugins.names() else plugins.REGISTRY.get(self.cmd_map.get(name, name))
+            if plugin is None:
+                output.append('No plugin for {}.'.format(repr(name)))
+                continue
+            try:
+                plugins.reload_plugin(plugin)
+            except Exception as e:
+                output.append('Failed to reload {}: {}'.format(plugin, e))
+                continue
+            output.append('Reloaded {}.'.format(plugin))
+        return '\n'.join(output)
 
     #### TEST
     def _test(self, args):
@@ -462,128 +423,22 @@ class BotCommand(object):
             output.append(UsageTracker.get_usage(arg))
         return '\n'.join(output)
 
-    #### WEATHER
-    def _weather(self, args, raw=False):
-        """Usage: `{cmd_prefix}weather *zip_codes`"""
-        if not args:
-            args = ['92618']
-        output = []
-        for city in args:
-            output.append(self._weather_get(city, raw=raw))
-        return '\n'.join(output)
-
-    def _weather_get(self, city, raw=False):
-        url = 'http://api.openweathermap.org/data/2.5/weather?{}={}'
-        if all(c in '0123456789' for c in city):
-            try:
-                resp = urlgrabber.urlread(url.format('zip', city), size=2097152*10)
-            except urlgrabber.grabber.URLGrabError:
-                resp = 'Failed to fetch weather for {}'.format(repr(city))
-        else:
-            try:
-                resp = urlgrabber.urlread(url.format('q', self._weather_parse_city(city)), size=2097152*10)
-            except urlgrabber.grabber.URLGrabError:
-                resp = 'Failed to fetch weather for {}'.format(repr(city))
-        if raw:
-            return resp
+    #### MORE
+    def _more(self, args):
+        """Usage: `{cmd_prefix}more` for the next page of the last long output"""
+        page, left = self.pager.next()
+        if page is not None:
+            self.throttler.enqueue(page)
+            return self.more_hint(left) if left else ''
+        # only %mysql parks streams, so there is nothing to find until it has set the database up
+        database = sys.modules.get('database')
+        stream = None
+        if database is not None and database._shared is not None:
+            stream = database._shared.more((self.username, self.groupname))
+        if stream is None:
+            return 'Nothing more.'
         try:
-            json_data = json.loads(resp)
-            return 'Current weather for {city}: {desc}, low:{low:.1f} high:{cur:.1f} currently:{high:.1f}'.format(
-                city=json_data['name'],
-                desc=json_data['weather'][0]['description'],
-                low=self._weather_convert(json_data['main']['temp_min']),
-                cur=self._weather_convert(json_data['main']['temp']),
-                high=self._weather_convert(json_data['main']['temp_max']),
-            )
-        except (KeyError, ValueError):
-            return 'API error for {}: {}'.format(repr(city), resp)
-
-    def _weather_parse_city(self, value):
-        city = value
-        state = ''
-        country = 'us'
-        if city.count(',') == 2:
-            city, state, country = value.split(',')
-            country = '{}'.format(country)
-        elif city.count(',') == 1:
-            city, state = value.split(',')
-        return ','.join([v for v in (city.strip(), state.strip(), country.strip()) if v])
-
-    def _weather_convert(self, value):
-        return (value - 273.15) * 1.8 + 32
-
-    def _weather_raw(self, args):
-        """Usage: `{cmd_prefix}weather_raw *zip_codes`"""
-        return self._weather(args, raw=True)
-
-    #### JOIN
-    @auth.requires_login(user_level=auth.SessionManager.TRUSTED_USER)
-    def _join(self, args):
-        for arg in args:
-            chan = '{}{}'.format('#' if not arg.startswith('#') else '', arg)
-            print chan
-            for account in settings.accounts:
-                account.client.joinGroup(chan)
-
-    #### LEAVE
-    @auth.requires_login(user_level=auth.SessionManager.TRUSTED_USER)
-    def _leave(self, args):
-        args = args if args else [self.groupname]
-        if not args:
-            args = [] if not self.groupname else [self.groupname]
-        for arg in args:
-            chan = '{}{}'.format('#' if not arg.startswith('#') else '', arg)
-            for account in settings.accounts:
-                account.client.leave(chan)
-
-    #### STATUS
-    @auth.requires_login(user_level=auth.SessionManager.BASIC_USER)
-    def _status(self, args):
-        output = []
-        for arg in args:
-            for account in settings.accounts:
-                person = account.client.getPerson(arg)
-                if person:
-                    # print dir(person)
-                    output.append('Idle:{}  Commands:{}  Status:{}  IMP_W:{}  Online:{}'.format(
-                        repr(person.getIdleTime()),
-                        repr(person.getPersonCommands()),
-                        repr(person.getStatus()),
-                        repr(person.imperson_whois()),
-                        repr(person.isOnline()),
-                    ))
-                else:
-                    output.append('Person {} not found.'.format(repr(self.username)))
-                    # import ipdb; ipdb.set_trace() # BREAKPOINT
-        return '\n'.join(output)
-
-    #### CLIENT
-    @auth.requires_login(user_level=auth.SessionManager.GOD_USER)
-    def _client(self, args):
-        if not args:
-            return None
-        for account in settings.accounts:
-            try:
-                return repr(getattr(account, args[0])(*args[1:]))
-            except TypeError:
-                return repr(getattr(account, args[0]))
-            except AttributeError:
-                return repr(dir(account))
-
-    #### MYSQL
-    @auth.requires_login(user_level=auth.SessionManager.GOD_USER)
-    def _mysql(self, args):
-        """Usage: `{cmd_prefix}mysql DB Query [DB Query, ...]`"""
-        output = []
-        for arg1, arg2 in n_at_a_time(args, 2):
-            cmd = '/usr/bin/mysql {} -e "{}"'.format(arg1, arg2)
-            try:
-                output.append(subprocess.check_output(cmd))
-            except Exception as e:
-                output.append('Failed on command: {} with error {}'.format(repr(cmd), e))
-        return '\n'.join(output)
-
-    #### PS
-    @auth.requires_login(user_level=auth.SessionManager.BASIC_USER)
-    def _ps(self, args):
-        return '\n'.join([str(p) for p in psutil.process_iter()])
+            self.throttler.enqueue(stream.page())
+        except database.DatabaseError as e:
+            return 'Failed: {}'.format(e)
+        return 'More rows: `{}more`'.format(self.CMD_PREFIX) if not stream.done else ''
@@ -0,0 +1,58 @@
+import os
+import json
+import time
+import atexit
+import settings
+
+# kinds: pm and msg carry text, nick carries the new nick, topic the topic
+FIELDS = ('t', 'kind', 'target', 'nick', 'text')
+
+
+class Capture(object):
+    """Inbound events appended to a file as compact JSON arrays, one per line.
+
+    Writes go through a large file buffer, so recording on the reactor
+    thread costs a json.dumps and a memory copy.
+    """
+
+    def __init__(self, path, buffering=2 ** 16):
+        self.file = open(path, 'ab', buffering)
+
+    def record(self, kind, target, nick, text=''):
+        self.file.write(json.dumps(
+            [round(time.time(), 3), kind, target, nick, text.decode('utf-8', 'replace') if isinstance(text, str) else text],
+            separators=(',', ':'),
+        ) + '\n')
+
+    def close(self):
+        self.file.close()
+
+
+def read(path):
+    """Captured events as dicts, oldest first; a torn last line is skipped."""
+    with open(path) as capture:
+        for line in capture:
+            try:
+                values = json.loads(line)
+            except ValueError:
+                continue
+            event = dict(zip(FIELDS, values))
+            for field in ('target', 'nick', 'text'):
+                if isinstance(event.get(field), unicode):
+                    event[field] = event[field].encode('utf-8')
+            yield event
+
+
+_shared = None
+
+
+def record(kind, target, nick, text=''):
+    """Record an event when settings.capture_file is set; reactor thread only."""
+    global _shared
+    if _shared is None:
+        path = getattr(settings, 'capture_file', None)
+        _shared = Capture(os.path.expanduser(path)) if path else False
+        if _shared:
+            atexit.register(_shared.close)
+    if _shared:
+        _shared.record(kind, target, nick, text)
@@ -0,0 +1,204 @@
+import time
+import sqlite3
+import settings
+import threading
+import collections
+
+PAGE_ROWS = 20
+CELL_WIDTH = 60
+CONTINUATION_TIMEOUT = 300
+
+
+class DatabaseError(Exception):
+    pass
+
+
+class SQLiteBackend(object):
+    """Databases are files named by settings.sqlite_path, e.g. '/srv/db/{database}.sqlite3'."""
+    Error = sqlite3.Error
+
+    def __init__(self, path='{database}.sqlite3'):
+        self.path = path
+
+    def connect(self, database):
+        return sqlite3.connect(self.path.format(database=database), check_same_thread=False)
+
+    def cursor(self, connection):
+        # sqlite steps through results as they are fetched
+        return connection.cursor()
+
+
+class MySQLBackend(object):
+    def __init__(self, **connect_kwargs):
+        try:
+            import MySQLdb
+            import MySQLdb.cursors
+        except ImportError as e:
+            raise DatabaseError('MySQLdb is not installed ({}); set database_backend'.format(e))
+        self.MySQLdb = MySQLdb
+        self.Error = MySQLdb.Error
+        self.connect_kwargs = connect_kwargs
+
+    def connect(self, database):
+        return self.MySQLdb.connect(db=database, **self.connect_kwargs)
+
+    def cursor(self, connection):
+        # server side cursor: rows stay on the server until fetched
+        return connection.cursor(self.MySQLdb.cursors.SSCursor)
+
+
+class Pool(object):
+    """Idle connections kept per database."""
+
+    def __init__(self, backend, max_idle=2):
+        self.backend = backend
+        self.max_idle = max_idle
+        self.idle = collections.defaultdict(list)
+        self.lock = threading.Lock()
+
+    def acquire(self, database):
+        with self.lock:
+            if self.idle[database]:
+                return self.idle[database].pop()
+        return self.backend.connect(database)
+
+    def release(self, database, connection):
+        with self.lock:
+            if len(self.idle[database]) < self.max_idle:
+                self.idle[database].append(connection)
+                return
+        connection.close()
+
+
+class ResultStream(object):
+    """Rows of one query, fetched and formatted a page at a time."""
+
+    def __init__(self, pool, database, connection, cursor, page_rows=PAGE_ROWS):
+        self.pool = pool
+        self.database = database
+        self.connection = connection
+        self.cursor = cursor
+        self.page_rows = page_rows
+        self.columns = [column[0] for column in cursor.description or ()]
+        self.rowcount = cursor.rowcount
+        self.done = not self.columns
+        self.ahead = []
+        self.touched = time.time()
+        self.lock = threading.Lock()
+
+    def page(self):
+        """The next page_rows rows as a table; closes the stream after the last one."""
+        with self.lock:
+            if self.done:
+                return ''
+            self.touched = time.time()
+            # one row of lookahead tells us whether another page exists
+            try:
+                rows = self.ahead + self.cursor.fetchmany(self.page_rows + 1 - len(self.ahead))
+            except self.pool.backend.Error as e:
+                self.close(broken=True)
+                raise DatabaseError(str(e))
+            self.ahead = rows[self.page_rows:]
+            if not self.ahead:
+                self.close()
+            return table(self.columns, rows[:self.page_rows])
+
+    def close(self, broken=False):
+        if self.connection is None:
+            return
+        self.done = True
+        try:
+            self.cursor.close()
+        except self.pool.backend.Error:
+            broken = True
+        if broken:
+            self.connection.close()
+        else:
+            self.pool.release(self.database, self.connection)
+        self.connection = None
+
+
+def cell(value):
+    if value is None:
+        return 'NULL'
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    value = ' '.join(str(value).split())
+    if len(value) > CELL_WIDTH:
+        value = value[:CELL_WIDTH - 3] + '...'
+    return value
+
+
+def table(columns, rows):
+    """Columns padded to the widest cell on this page, separated by '|'."""
+    cells = [list(columns)] + [[cell(value) for value in row] for row in rows]
+    widths = [max(len(row[i]) for row in cells) for i in xrange(len(columns))]
+    return '\n'.join('|'.join(value.ljust(width) for value, width in zip(row, widths)).rstrip() for row in cells)
+
+
+class Database(object):
+    def __init__(self, backend, max_idle=2, page_rows=PAGE_ROWS):
+        self.pool = Pool(backend, max_idle=max_idle)
+        self.page_rows = page_rows
+        self.continuations = {}
+        self.lock = threading.Lock()
+
+    def execute(self, database, query):
+        """A ResultStream over query's rows; statements without rows are committed and closed."""
+        try:
+            connection = self.pool.acquire(database)
+        except self.pool.backend.Error as e:
+            raise DatabaseError(str(e))
+        try:
+            cursor = self.pool.backend.cursor(connection)
+            cursor.execute(query)
+        except self.pool.backend.Error as e:
+            connection.close()
+            raise DatabaseError(str(e))
+        stream = ResultStream(self.pool, database, connection, cursor, self.page_rows)
+        if stream.done:
+            connection.commit()
+            stream.close()
+        return stream
+
+    def keep(self, owner, stream):
+        """Park a stream with more rows until owner asks for them with more()."""
+        with self.lock:
+            self.expire()
+            old = self.continuations.pop(owner, None)
+            self.continuations[owner] = stream
+        if old is not None:
+            old.close()
+
+    def more(self, owner):
+        """owner's parked stream, or None once it has run out or expired."""
+        with self.lock:
+            self.expire()
+            return self.continuations.get(owner)
+
+    def expire(self):
+        now = time.time()
+        for owner, stream in self.continuations.items():
+            if stream.done or now - stream.touched > CONTINUATION_TIMEOUT:
+                stream.close()
+                del self.continuations[owner]
+
+
+_shared = None
+_shared_lock = threading.Lock()
+
+
+def shared():
+    global _shared
+    with _shared_lock:
+        if _shared is None:
+            if getattr(settings, 'database_backend', 'mysql') == 'sqlite':
+                backend = SQLiteBackend(getattr(settings, 'sqlite_path', '{database}.sqlite3'))
+            else:
+                backend = MySQLBackend(**getattr(settings, 'mysql', {}))
+            _shared = Database(
+                backend,
+                max_idle=getattr(settings, 'database_max_idle', 2),
+                page_rows=getattr(settings, 'database_page_rows', PAGE_ROWS),
+            )
+        return _shared
@@ -0,0 +1,299 @@
+import re
+import math
+import random
+import threading
+import collections
+
+MAX_COUNT = 10 ** 12
+MAX_SIDES = 10 ** 6
+# up to ROLL_LIMIT dice are rolled one by one, and listed when there are at most SHOW_LIMIT
+ROLL_LIMIT = 10000
+SHOW_LIMIT = 20
+# more dice than that are tallied per face, for dice with at most FACE_LIMIT sides
+FACE_LIMIT = 10000
+# most distinct totals (or kept-dice states) a distribution is computed over
+DIST_LIMIT = 1000
+# keep distributions track multisets of kept faces: at most KEEP_STATES of them,
+# and at most KEEP_WORK state x face steps in all
+KEEP_STATES = 10000
+KEEP_WORK = 2000000
+CACHE_SIZE = 256
+
+TOKEN = re.compile(r'\s*(?:(\d*)d(%|\d*)(?:(kh|kl|dh|dl|k|d)(\d+))?|(\d+)|([-+*x]))')
+
+# sign is 1 or -1; sides is None for a constant, which is then count;
+# keep is None or ('h' or 'l', number of dice kept)
+Term = collections.namedtuple('Term', ('sign', 'count', 'sides', 'keep', 'multiplier'))
+
+
+class DiceError(ValueError):
+    pass
+
+
+class Expression(object):
+    def __init__(self, text, terms):
+        self.text = text
+        self.terms = terms
+
+
+def parse(text):
+    """Expression for text like '4d6dl1+2', '3d20kh1-1d4', '2d6*10', 'd%'."""
+    text = text.lower().replace(' ', '')
+    terms = []
+    sign = 1
+    pos = 0
+    expect_operand = True
+    while pos < len(text):
+        match = TOKEN.match(text, pos)
+        if match is None or match.end() == pos:
+            raise DiceError('Cannot read {!r} at {!r}'.format(text, text[pos:]))
+        pos = match.end()
+        count, sides, keep, kept, constant, operator = match.groups()
+        if operator in ('*', 'x'):
+            if expect_operand:
+                raise DiceError('Nothing to multiply in {!r}'.format(text))
+            multiplier = TOKEN.match(text, pos)
+            if multiplier is None or multiplier.group(5) is None:
+                raise DiceError('Multiply by a number in {!r}'.format(text))
+            pos = multiplier.end()
+            terms[-1] = terms[-1]._replace(multiplier=terms[-1].multiplier * int(multiplier.group(5)))
+        elif operator:
+            if not expect_operand:
+                sign = 1
+            sign *= -1 if operator == '-' else 1
+            expect_operand = True
+        elif not expect_operand:
+            raise DiceError('Missing + or - in {!r}'.format(text))
+        elif constant is not None:
+            terms.append(Term(sign, int(constant), None, None, 1))
+            expect_operand = False
+        else:
+            terms.append(dice_term(sign, count, sides, keep, kept))
+            expect_operand = False
+    if expect_operand:
+        raise DiceError('Incomplete expression {!r}'.format(text))
+    return Expression(text, terms)
+
+
+def dice_term(sign, count, sides, keep, kept):
+    count = int(count) if count else 1
+    sides = 100 if sides == '%' else int(sides) if sides else 6
+    if not 1 <= count <= MAX_COUNT or not 1 <= sides <= MAX_SIDES:
+        raise DiceError('Between 1 and {} dice of 1 to {} sides'.format(MAX_COUNT, MAX_SIDES))
+    if keep is not None:
+        kept = int(kept)
+        if kept > count:
+            raise DiceError('Cannot keep or drop {} of {} dice'.format(kept, count))
+        if keep in ('d', 'dl'):
+            keep = ('h', count - kept)
+        elif keep == 'dh':
+            keep = ('l', count - kept)
+        else:
+            keep = (keep[-1] if keep != 'k' else 'h', kept)
+    return Term(sign, count, sides, keep, 1)
+
+
+_cache = collections.OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def expression(text):
+    """parse, remembering the last CACHE_SIZE expressions."""
+    with _cache_lock:
+        if text in _cache:
+            parsed = _cache.pop(text)
+            _cache[text] = parsed
+            return parsed
+    parsed = parse(text)
+    with _cache_lock:
+        _cache[text] = parsed
+        while len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+    return parsed
+
+
+#### ROLLING
+
+def binomial(n, p):
+    """Successes in n trials of probability p; exact for small n*p, normal approximation beyond."""
+    if p <= 0:
+        return 0
+    if p >= 1:
+        return n
+    if p > 0.5:
+        return n - binomial(n, 1 - p)
+    if n * p < 30:
+        # skip from success to success with geometric waiting times
+        log_q = math.log(1 - p)
+        successes = 0
+        trial = 0
+        while True:
+            trial += int(math.log(1.0 - random.random()) / log_q) + 1
+            if trial > n:
+                return successes
+            successes += 1
+    value = int(round(random.gauss(n * p, math.sqrt(n * p * (1 - p)))))
+    return min(max(value, 0), n)
+
+
+def face_counts(count, sides):
+    """How many of count dice landed on each face, as a multinomial draw in O(sides) memory."""
+    counts = []
+    left = count
+    for face in xrange(1, sides):
+        rolled = binomial(left, 1.0 / (sides - face + 1))
+        counts.append(rolled)
+        left -= rolled
+    counts.append(left)
+    return counts
+
+
+def kept_total(counts, keep):
+    """Sum of the kept dice given per-face counts."""
+    if keep is None:
+        return sum(face * n for face, n in enumerate(counts, 1))
+    high, kept = keep
+    faces = xrange(len(counts), 0, -1) if high == 'h' else xrange(1, len(counts) + 1)
+    total = 0
+    for face in faces:
+        take = min(kept, counts[face - 1])
+        total += face * take
+        kept -= take
+        if not kept:
+            break
+    return total
+
+
+def roll_term(term):
+    """(total, individual rolls or None when there are too many to list)."""
+    if term.sides is None:
+        return term.sign * term.count * term.multiplier, [term.count]
+    count, sides, keep = term.count, term.sides, term.keep
+    rolls = None
+    if count <= ROLL_LIMIT:
+        rolled = [random.randint(1, sides) for _ in xrange(count)]
+        if keep is None:
+            total = sum(rolled)
+        else:
+            ordered = sorted(rolled, reverse=keep[0] == 'h')
+            total = sum(ordered[:keep[1]])
+        if count <= SHOW_LIMIT:
+            rolls = rolled
+    elif sides <= FACE_LIMIT:
+        total = kept_total(face_counts(count, sides), keep)
+    elif keep is None:
+        # enough dice that their sum is normal
+        mean = count * (sides + 1) / 2.0
+        deviation = math.sqrt(count * (sides * sides - 1) / 12.0)
+        total = min(max(int(round(random.gauss(mean, deviation))), count), count * sides)
+    else:
+        raise DiceError('Cannot keep or drop among more than {} dice of over {} sides'.format(ROLL_LIMIT, FACE_LIMIT))
+    return term.sign * total * term.multiplier, rolls
+
+
+def roll(text):
+    """(total, per term rolls) for an expression; terms with too many dice to list show as 'NdS'."""
+    parsed = expression(text)
+    total = 0
+    rolls = []
+    for term in parsed.terms:
+        value, term_rolls = roll_term(term)
+        total += value
+        rolls.append(term_rolls if term_rolls is not None else '{}d{}'.format(term.count, term.sides))
+    return total, rolls
+
+
+#### DISTRIBUTION
+
+def convolve(a, b):
+    """Distribution of the sum of two independent {value: probability} distributions."""
+    if len(a) * len(b) > DIST_LIMIT * DIST_LIMIT:
+        raise DiceError('Distribution too large')
+    result = collections.defaultdict(float)
+    for x, p in a.iteritems():
+        for y, q in b.iteritems():
+            result[x + y] += p * q
+    if len(result) > DIST_LIMIT:
+        raise DiceError('Distribution has more than {} outcomes'.format(DIST_LIMIT))
+    return result
+
+
+def sum_distribution(count, sides):
+    """count dice summed, by squaring the one die distribution."""
+    if count * (sides - 1) + 1 > DIST_LIMIT:
+        raise DiceError('Distribution has more than {} outcomes'.format(DIST_LIMIT))
+    die = dict((face, 1.0 / sides) for face in xrange(1, sides + 1))
+    result = {0: 1.0}
+    while count:
+        if count & 1:
+            result = convolve(result, die)
+        count >>= 1
+        if count:
+            die = convolve(die, die)
+    return result
+
+
+def multisets(sides, kept, limit):
+    """C(sides + kept - 1, kept), or limit + 1 as soon as it passes limit."""
+    ways = 1
+    for i in xrange(1, kept + 1):
+        ways = ways * (sides + i - 1) // i
+        if ways > limit:
+            return limit + 1
+    return ways
+
+
+def check_keep(count, sides, keep):
+    """Refuse before any work when the kept face multisets can't fit the limits."""
+    kept = keep[1]
+    states = multisets(sides, kept, KEEP_STATES)
+    if states > KEEP_STATES or count * states * sides > KEEP_WORK:
+        raise DiceError('Too many ways to keep {} of {}d{}'.format(kept, count, sides))
+
+
+def keep_distribution(count, sides, keep):
+    """Sum of the kept dice, following the multiset of kept faces die by die."""
+    high, kept = keep
+    if not kept:
+        return {0: 1.0}
+    check_keep(count, sides, keep)
+    states = {(): 1.0}
+    for _ in xrange(count):
+        following = collections.defaultdict(float)
+        for state, p in states.iteritems():
+            for face in xrange(1, sides + 1):
+                faces = sorted(state + (face,), reverse=high == 'h')[:kept]
+                following[tuple(faces)] += p / sides
+        states = following
+    result = collections.defaultdict(float)
+    for state, p in states.iteritems():
+        result[sum(state)] += p
+    return result
+
+
+def distribution(text):
+    """Exact {total: probability} for an expression."""
+    terms = expression(text).terms
+    for term in terms:
+        if term.sides is not None and term.keep is not None and 0 < term.keep[1] < term.count:
+            check_keep(term.count, term.sides, term.keep)
+    result = {0: 1.0}
+    for term in terms:
+        if term.sides is None:
+            dist = {term.count: 1.0}
+        elif term.keep is None or term.keep[1] == term.count:
+            dist = sum_distribution(term.count, term.sides)
+        else:
+            dist = keep_distribution(term.count, term.sides, term.keep)
+        factor = term.sign * term.multiplier
+        result = convolve(result, dict((value * factor, p) for value, p in dist.iteritems()))
+    return result
+
+
+def describe(dist, per_line=8):
+    mean = sum(value * p for value, p in dist.iteritems())
+    deviation = math.sqrt(sum((value - mean) ** 2 * p for value, p in dist.iteritems()))
+    cells = ['{}:{:.2f}%'.format(value, p * 100) for value, p in sorted(dist.iteritems())]
+    lines = ['mean {:.2f} sd {:.2f} min {} max {}'.format(mean, deviation, min(dist), max(dist))]
+    lines.extend(' '.join(cells[i:i + per_line]) for i in xrange(0, len(cells), per_line))
+    return '\n'.join(lines)
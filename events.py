@@ -0,0 +1,184 @@
+import os
+import json
+import bisect
+import settings
+import threading
+
+# one index entry every INDEX_EVERY events: "timestamp offset"
+INDEX_EVERY = 256
+
+
+def record(when, kind, nick, channel, text=''):
+    return {'t': round(when, 3), 'k': kind, 'n': nick, 'c': channel, 'x': text}
+
+
+def decode(value):
+    if isinstance(value, str):
+        return value.decode('utf-8', 'replace')
+    return value
+
+
+class EventLog(object):
+    """Channel events as JSON lines in segment files, each with a sparse time index.
+
+    Segments are named by the time of their first event, so picking the
+    segments for a time range needs only a directory listing, and the index
+    narrows the first one down to INDEX_EVERY events.  One thread appends;
+    any thread may read.
+    """
+
+    def __init__(self, directory, segment_bytes=2 ** 24, segment_age=86400, keep=30):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.segment_age = segment_age
+        self.keep = keep
+        self.file = None
+        self.index = None
+        self.started = None
+        self.count = 0
+
+    #### WRITING
+    def append(self, events):
+        """events are (when, kind, nick, channel, text) tuples, oldest first."""
+        for when, kind, nick, channel, text in events:
+            if self.file is None or self.file.tell() >= self.segment_bytes or when - self.started >= self.segment_age:
+                self.roll(when)
+            line = json.dumps(
+                record(when, kind, decode(nick), decode(channel), decode(text)),
+                separators=(',', ':'),
+            )
+            if not self.count % INDEX_EVERY:
+                self.index.write('{:.3f} {}\n'.format(when, self.file.tell()))
+            self.file.write(line + '\n')
+            self.count += 1
+
+    def roll(self, when):
+        self.close()
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        self.started = when
+        name = os.path.join(self.directory, '{:.3f}'.format(when))
+        self.file = open(name + '.jsonl', 'a')
+        self.index = open(name + '.idx', 'a')
+        self.count = 0
+        segments = self.segments()
+        for start, path in segments[:-self.keep] if self.keep else []:
+            os.remove(path)
+            os.remove(path[:-len('.jsonl')] + '.idx')
+
+    def flush(self):
+        if self.file is not None:
+            self.file.flush()
+            self.index.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.index.close()
+            self.file = self.index = None
+
+    #### READING
+    def segments(self):
+        """[(start time, path)] oldest first."""
+        if not os.path.isdir(self.directory):
+            return []
+        found = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.jsonl'):
+                try:
+                    found.append((float(name[:-len('.jsonl')]), os.path.join(self.directory, name)))
+                except ValueError:
+                    pass
+        return sorted(found)
+
+    def offsets(self, path):
+        """Index of a segment as ([times], [offsets])."""
+        times = []
+        offsets = []
+        try:
+            with open(path[:-len('.jsonl')] + '.idx') as index:
+                for line in index:
+                    parts = line.split()
+                    if len(parts) == 2:
+                        times.append(float(parts[0]))
+                        offsets.append(int(parts[1]))
+        except IOError:
+            pass
+        return times, offsets
+
+    def lines(self, path, offset):
+        with open(path) as segment:
+            segment.seek(offset)
+            for line in segment:
+                yield line
+
+    def parse(self, line, needle):
+        if needle is not None and needle not in line:
+            return None
+        try:
+            return json.loads(line)
+        except ValueError:
+            # an event still being written
+            return None
+
+    def forward(self, since, needle=None, max_bytes=2 ** 26):
+        """Events from since on, oldest first.
+
+        needle, when given, is a substring of the raw JSON line every wanted event has.
+        """
+        segments = self.segments()
+        starts = [start for start, path in segments]
+        first = max(bisect.bisect_right(starts, since) - 1, 0)
+        read = 0
+        for start, path in segments[first:]:
+            times, offsets = self.offsets(path)
+            entry = bisect.bisect_right(times, since) - 1
+            for line in self.lines(path, offsets[entry] if entry >= 0 else 0):
+                read += len(line)
+                if read > max_bytes:
+                    return
+                event = self.parse(line, needle)
+                if event is not None and event['t'] >= since:
+                    yield event
+
+    def backward(self, needle=None, max_bytes=2 ** 26):
+        """Events newest first, read an index block at a time."""
+        read = 0
+        for start, path in reversed(self.segments()):
+            times, offsets = self.offsets(path)
+            bounds = [0] + offsets + [os.path.getsize(path)]
+            with open(path) as segment:
+                for begin, end in reversed(zip(bounds, bounds[1:])):
+                    if begin >= end:
+                        continue
+                    segment.seek(begin)
+                    block = segment.read(end - begin)
+                    read += len(block)
+                    if read > max_bytes:
+                        return
+                    for line in reversed(block.split('\n')):
+                        event = self.parse(line, needle) if line else None
+                        if event is not None:
+                            yield event
+
+
+def needle(field, value):
+    """Substring of an event's JSON line when field is value."""
+    return '"{}":{}'.format(field, json.dumps(decode(value)))
+
+
+_shared = None
+_shared_lock = threading.Lock()
+
+
+def shared():
+    global _shared
+    with _shared_lock:
+        if _shared is None:
+            _shared = EventLog(
+                os.path.expanduser(getattr(settings, 'events_dir', '~/log/events')),
+                segment_bytes=getattr(settings, 'events_segment_bytes', 2 ** 24),
+                segment_age=getattr(settings, 'events_segment_age', 86400),
+                keep=getattr(settings, 'events_keep', 30),
+            )
+        return _shared
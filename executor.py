@@ -0,0 +1,110 @@
+import logger
+import settings
+import threading
+import traceback
+import collections
+
+
+class CommandExecutor(object):
+    HIGH = 0
+    NORMAL = 1
+    LANES = (HIGH, NORMAL)
+
+    def __init__(self, workers=4, max_queued=64, max_queued_per_owner=8, max_high=16, max_high_per_owner=2):
+        self.workers = workers
+        # per lane: (total queued, queued per owner); each lane is bounded on its own
+        self.limits = {
+            self.HIGH: (max_high, max_high_per_owner),
+            self.NORMAL: (max_queued, max_queued_per_owner),
+        }
+        self.cond = threading.Condition()
+        # per lane: owner -> deque of jobs, plus a ring of owners with work
+        self.queues = dict((lane, {}) for lane in self.LANES)
+        self.rings = dict((lane, collections.deque()) for lane in self.LANES)
+        self.counts = dict((lane, 0) for lane in self.LANES)
+        # jobs taken by a worker and not finished yet
+        self.running = 0
+        self.threads = []
+
+    def start(self):
+        with self.cond:
+            if self.threads:
+                return
+            for i in xrange(self.workers):
+                thread = threading.Thread(target=self.worker, name='executor-{}'.format(i))
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+
+    def submit(self, owner, func, priority=NORMAL):
+        self.start()
+        with self.cond:
+            queues = self.queues[priority]
+            pending = queues.get(owner)
+            max_queued, max_queued_per_owner = self.limits[priority]
+            if self.counts[priority] >= max_queued:
+                return False
+            if pending and len(pending) >= max_queued_per_owner:
+                return False
+            if pending is None:
+                pending = queues[owner] = collections.deque()
+                self.rings[priority].append(owner)
+            pending.append(func)
+            self.counts[priority] += 1
+            self.cond.notify()
+            return True
+
+    def take(self):
+        with self.cond:
+            while True:
+                for lane in self.LANES:
+                    ring = self.rings[lane]
+                    if not ring:
+                        continue
+                    owner = ring.popleft()
+                    pending = self.queues[lane][owner]
+                    func = pending.popleft()
+                    if pending:
+                        ring.append(owner)
+                    else:
+                        del self.queues[lane][owner]
+                    self.counts[lane] -= 1
+                    self.running += 1
+                    return func
+                self.cond.wait()
+
+    def worker(self):
+        while True:
+            func = self.take()
+            try:
+                func()
+            except Exception:
+                logger.log(
+                    ('-!- COMMAND CRASHED -!- ', ': ', traceback.format_exc()),
+                    (settings.cd['e'], None, settings.cd['e']),
+                )
+            finally:
+                with self.cond:
+                    self.running -= 1
+
+    @property
+    def depth(self):
+        return sum(self.counts.itervalues())
+
+
+_shared = None
+_shared_lock = threading.Lock()
+
+
+def shared():
+    global _shared
+    with _shared_lock:
+        if _shared is None:
+            _shared = CommandExecutor(
+                workers=getattr(settings, 'executor_workers', 4),
+                max_queued=getattr(settings, 'executor_queue_size', 64),
+                max_queued_per_owner=getattr(settings, 'executor_owner_queue_size', 8),
+                max_high=getattr(settings, 'executor_priority_queue_size', 16),
+                max_high_per_owner=getattr(settings, 'executor_priority_owner_queue_size', 2),
+            )
+        return _shared
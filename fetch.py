@@ -0,0 +1,284 @@
+import re
+import time
+import codecs
+import hashlib
+import storage
+import settings
+import threading
+import webclient
+import HTMLParser
+import collections
+
+TITLE_MAX_BYTES = 131072
+HTML_TYPES = ('text/html', 'application/xhtml+xml')
+FetchError = webclient.FetchError
+
+
+class Entry(object):
+    __slots__ = ('body', 'etag', 'last_modified', 'fetched')
+
+    def __init__(self, body, etag=None, last_modified=None, fetched=None):
+        self.body = body
+        self.etag = etag
+        self.last_modified = last_modified
+        self.fetched = time.time() if fetched is None else fetched
+
+    def fresh(self, ttl):
+        return time.time() - self.fetched < ttl
+
+
+class LRU(object):
+    """Entries by url, evicting least recently used once bodies pass max_bytes."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, url):
+        with self.lock:
+            entry = self.entries.pop(url, None)
+            if entry is not None:
+                self.entries[url] = entry
+            return entry
+
+    def put(self, url, entry):
+        with self.lock:
+            old = self.entries.pop(url, None)
+            if old is not None:
+                self.size -= len(old.body)
+            if len(entry.body) > self.max_bytes:
+                return
+            self.entries[url] = entry
+            self.size += len(entry.body)
+            while self.size > self.max_bytes:
+                _, old = self.entries.popitem(last=False)
+                self.size -= len(old.body)
+
+
+class TitleParser(object):
+    """Incremental search for <title> or og:title in the start of a document."""
+    TITLE = re.compile(r'<title\b[^>]*>(.*?)</title\s*>', re.I | re.S)
+    OG_TITLE = re.compile(r'<meta\b[^>]*\bog:title\b[^>]*>', re.I)
+    CONTENT = re.compile(r'\bcontent\s*=\s*(?:"([^"]*)"|\'([^\']*)\')', re.I)
+    END_OF_HEAD = re.compile(r'</head\s*>|<body\b', re.I)
+
+    def __init__(self):
+        self.charset = 'utf-8'
+        self.mime = None
+        self.buf = ''
+        self.title = None
+        self.done = False
+
+    def accepts(self, content_type):
+        self.mime = content_type.split(';')[0].strip().lower()
+        self.charset = charset(content_type)
+        return self.mime in HTML_TYPES
+
+    def feed(self, data):
+        self.buf += data
+        match = self.TITLE.search(self.buf)
+        if match:
+            self.title = self.clean(match.group(1))
+            self.done = True
+            return
+        match = self.OG_TITLE.search(self.buf)
+        content = match and self.CONTENT.search(match.group(0))
+        if content:
+            self.title = self.clean(content.group(1) or content.group(2) or '')
+            self.done = True
+            return
+        if self.END_OF_HEAD.search(self.buf):
+            self.done = True
+
+    def clean(self, raw):
+        text = HTMLParser.HTMLParser().unescape(raw.decode(self.charset, 'replace'))
+        return ' '.join(text.split()).encode('utf-8')
+
+
+def charset(content_type):
+    match = re.search(r'charset\s*=\s*["\']?([\w.:-]+)', content_type, re.I)
+    if match:
+        try:
+            return codecs.lookup(match.group(1)).name
+        except LookupError:
+            pass
+    return 'utf-8'
+
+
+class Flight(object):
+    def __init__(self):
+        self.event = threading.Event()
+        self.body = None
+        self.error = None
+
+
+class FetchCache(object):
+    """Fetched results by key, in memory and optionally in redis, with concurrent misses coalesced.
+
+    Keys start with their kind ('title:', 'reddit:', 'weather:'), which the
+    counts are kept per.  Bodies are strings so the byte bound and the redis
+    tier cover every kind; callers decode their own.
+    """
+    REDIS_SEG = 'fetch'
+
+    def __init__(self, max_bytes, redis_tier=False, redis_ttl=3600, redis_max_body=524288):
+        self.memory = LRU(max_bytes)
+        self.redis_tier = redis_tier
+        self.redis_ttl = redis_ttl
+        self.redis_max_body = redis_max_body
+        self.lock = threading.Lock()
+        self.inflight = {}
+        self.counts = collections.defaultdict(collections.Counter)
+
+    def redis_key(self, url):
+        return '{}:{}:{}'.format(settings.redis_prefix, self.REDIS_SEG, hashlib.sha1(url).hexdigest())
+
+    def lookup(self, url):
+        entry = self.memory.get(url)
+        if entry is None and self.redis_tier:
+            fields = storage.client.hgetall(self.redis_key(url))
+            if fields:
+                entry = Entry(fields['body'], fields.get('etag'), fields.get('last_modified'), float(fields['fetched']))
+                self.memory.put(url, entry)
+        return entry
+
+    def store(self, url, entry):
+        self.memory.put(url, entry)
+        if self.redis_tier and len(entry.body) <= self.redis_max_body:
+            key = self.redis_key(url)
+            fields = {'body': entry.body, 'fetched': entry.fetched}
+            if entry.etag:
+                fields['etag'] = entry.etag
+            if entry.last_modified:
+                fields['last_modified'] = entry.last_modified
+            with storage.deferred() as pipe:
+                pipe.delete(key)
+                pipe.hmset(key, fields)
+                pipe.expire(key, self.redis_ttl)
+
+    def titles(self, urls, ttl):
+        keys = ['title:{}'.format(url) for url in urls]
+        return self.cached_many(keys, ttl, self.load_titles)
+
+    def cached_many(self, keys, ttl, load_many):
+        """Bodies, or exceptions, for keys in order; fresh entries are served from the cache.
+
+        load_many gets [(key, stale entry or None)] for the misses this thread
+        leads and returns an Entry or an exception for each; returning the
+        stale entry itself means it was revalidated.  Other threads missing
+        the same keys meanwhile wait for those results.
+        """
+        results = [None] * len(keys)
+        leaders = []
+        followers = []
+        for i, key in enumerate(keys):
+            entry = self.lookup(key)
+            if entry is not None and entry.fresh(ttl):
+                self.counts[kind(key)]['hits'] += 1
+                results[i] = entry.body
+                continue
+            with self.lock:
+                flight = self.inflight.get(key)
+                if flight is None:
+                    flight = self.inflight[key] = Flight()
+                    leaders.append((i, key, entry, flight))
+                else:
+                    followers.append((i, flight))
+        if leaders:
+            try:
+                loaded = load_many([(key, entry) for _, key, entry, _ in leaders])
+            except Exception as e:
+                loaded = [e] * len(leaders)
+            for (i, key, entry, flight), value in zip(leaders, loaded):
+                counts = self.counts[kind(key)]
+                if isinstance(value, Exception):
+                    counts['errors'] += 1
+                    flight.error = results[i] = value
+                else:
+                    counts['revalidated' if value is entry else 'misses'] += 1
+                    self.store(key, value)
+                    flight.body = results[i] = value.body
+                with self.lock:
+                    del self.inflight[key]
+                flight.event.set()
+        for i, flight in followers:
+            self.counts[kind(keys[i])]['coalesced'] += 1
+            flight.event.wait()
+            results[i] = flight.error if flight.error is not None else flight.body
+        return results
+
+    def load_titles(self, items):
+        max_bytes = getattr(settings, 'url_title_max_bytes', TITLE_MAX_BYTES)
+        requests = []
+        for key, entry in items:
+            headers = []
+            if entry is not None and entry.etag:
+                headers.append(('If-None-Match', entry.etag))
+            if entry is not None and entry.last_modified:
+                headers.append(('If-Modified-Since', entry.last_modified))
+            requests.append({'url': key[len('title:'):], 'headers': headers, 'parser': TitleParser(), 'max_bytes': max_bytes})
+        results = []
+        for (key, entry), response in zip(items, webclient.fetch_many(requests)):
+            if isinstance(response, Exception):
+                results.append(response)
+                continue
+            if response.code == 304 and entry is not None:
+                entry.fetched = time.time()
+                results.append(entry)
+                continue
+            parser = response.parser
+            if response.code >= 400:
+                title = 'HTTP {}'.format(response.code)
+            elif parser.title:
+                title = parser.title
+            elif parser.mime not in HTML_TYPES:
+                length = response.length if response.length is not None else '?'
+                title = '{} ({} bytes)'.format(parser.mime or 'unknown type', length)
+            else:
+                title = 'No title found'
+            results.append(Entry(title, response.header('etag'), response.header('last-modified')))
+        return results
+
+    def stats(self):
+        lines = ['Fetch cache: {} entries {} bytes'.format(len(self.memory.entries), self.memory.size)]
+        for name, counts in sorted(self.counts.items()):
+            counts = dict(counts)
+            # a revalidation costs a round trip but no body
+            served = sum(counts.get(k, 0) for k in ('hits', 'revalidated', 'coalesced'))
+            total = served + counts.get('misses', 0)
+            lines.append('  {}: hits:{} revalidated:{} coalesced:{} misses:{} errors:{}  hit rate:{:.1f}%'.format(
+                name,
+                counts.get('hits', 0),
+                counts.get('revalidated', 0),
+                counts.get('coalesced', 0),
+                counts.get('misses', 0),
+                counts.get('errors', 0),
+                100.0 * served / total if total else 0,
+            ))
+        return '\n'.join(lines)
+
+
+def kind(key):
+    return key.split(':', 1)[0]
+
+
+def ttl(command):
+    return getattr(settings, 'fetch_ttl', {}).get(command, 60)
+
+
+_shared = None
+_shared_lock = threading.Lock()
+
+
+def shared():
+    global _shared
+    with _shared_lock:
+        if _shared is None:
+            _shared = FetchCache(
+                max_bytes=getattr(settings, 'fetch_cache_bytes', 2 ** 25),
+                redis_tier=getattr(settings, 'fetch_redis_tier', False),
+                redis_ttl=getattr(settings, 'fetch_redis_ttl', 3600),
+            )
+        return _shared
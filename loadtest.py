@@ -0,0 +1,305 @@
+#!/usr/bin/env python
+"""Drive MinGroupConversation and MinConversation with fake transports and report as JSON.
+
+    python loadtest.py --rate 200 --duration 30 --mix chat=80,echo=10,dice=5,list=5
+    python loadtest.py --redis server --output before.json
+
+Latency is from handing a message to the conversation to the first line
+its command sends.  Flood control is lifted unless --throttle is given, so
+the numbers are about the bot rather than the configured send rate.
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import random
+import argparse
+import resource
+import threading
+import subprocess
+
+import bench
+
+COMMANDS = {
+    'echo': lambda i: '%echo load test {}'.format(i),
+    'test': lambda i: '%test',
+    'dice': lambda i: '%dice 4d6dl1+2 100d20',
+    'list': lambda i: '%list random loadtest',
+    'show': lambda i: '%list show loadtest',
+    'usage': lambda i: '%usage',
+}
+LIST_ITEMS = 10000
+
+
+def parse_mix(text):
+    mix = []
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        if name != 'chat' and name not in COMMANDS:
+            raise SystemExit('Unknown traffic {!r}, use chat or one of {}'.format(name, ', '.join(sorted(COMMANDS))))
+        mix.append((name, float(weight or 1)))
+    return mix
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def setup_redis(mode, settings):
+    """Point storage at the chosen redis before anything imports it; returns a process to stop."""
+    settings.redis_prefix = 'loadtest'
+    if mode == 'server':
+        port = free_port()
+        process = subprocess.Popen(
+            ['redis-server', '--port', str(port), '--save', '', '--appendonly', 'no'],
+            stdout=open(os.devnull, 'w'),
+        )
+        settings.redis_host = '127.0.0.1'
+        settings.redis_port = port
+        for _ in xrange(100):
+            try:
+                socket.create_connection(('127.0.0.1', port)).close()
+                break
+            except socket.error:
+                time.sleep(0.05)
+        return process
+    import storage
+    if mode == 'fake':
+        import fakeredis
+        storage.pool.connection_class = fakeredis.FakeConnection
+        storage.pool.connection_kwargs = {'server': fakeredis.FakeServer()}
+    return None
+
+
+class Probe(object):
+    """One command message and when its first line of output went out."""
+
+    def __init__(self, kind):
+        self.kind = kind
+        self.sent = None
+        self.first = None
+        self.lines = 0
+        self.rejected = False
+
+    def output(self, text, busy):
+        if self.first is None:
+            self.first = time.time()
+            self.rejected = text == busy
+        self.lines += 1
+
+
+class FakePerson(object):
+    account = bench.FakeAccount()
+
+    def __init__(self, name):
+        self.name = name
+
+
+def conversations(bot, busy):
+    class ProbeGroupConversation(bot.MinGroupConversation):
+        def __init__(self, group, chatui, probe):
+            bot.MinGroupConversation.__init__(self, group, chatui)
+            self.probe = probe
+
+        def sendText(self, text):
+            self.probe.output(text, busy)
+
+    class ProbeConversation(bot.MinConversation):
+        def __init__(self, person, chatui, probe):
+            bot.MinConversation.__init__(self, person, chatui)
+            self.probe = probe
+
+        def sendText(self, text):
+            self.probe.output(text, busy)
+
+    return ProbeGroupConversation, ProbeConversation
+
+
+def percentiles(values):
+    if not values:
+        return None
+    values = sorted(values)
+    pick = lambda p: values[int(round(p / 100.0 * (len(values) - 1)))]
+    return {
+        'p50': round(pick(50) * 1000, 3),
+        'p95': round(pick(95) * 1000, 3),
+        'p99': round(pick(99) * 1000, 3),
+        'max': round(values[-1] * 1000, 3),
+    }
+
+
+def commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=open(os.devnull, 'w'),
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(options):
+    import settings
+    process = setup_redis(options.redis, settings)
+    if not options.throttle:
+        settings.output_throttle = {None: {'burst': 10 ** 6, 'rate': 10 ** 6}}
+    if options.workers:
+        settings.executor_workers = options.workers
+    import bot
+    import logger
+    import storage
+    import executor
+    import botcommand
+    from twisted.internet import reactor
+
+    list_key = '{}:list:loadtest'.format(settings.redis_prefix)
+    storage.client.delete(list_key)
+    for start in xrange(0, LIST_ITEMS, 1000):
+        storage.client.lpush(list_key, *('item {}'.format(i) for i in xrange(start, start + 1000)))
+
+    busy = botcommand.BotCommand.BUSY_MESSAGE
+    group_class, private_class = conversations(bot, busy)
+    chatui = bot.MinChat()
+    channels = [bot.MinGroupConversation(bench.FakeGroup('#chat{}'.format(i)), chatui) for i in xrange(4)]
+    mix = parse_mix(options.mix)
+    total_weight = sum(weight for name, weight in mix)
+    rand = random.Random(options.seed)
+    probes = []
+    peak_threads = [threading.active_count()]
+    round_trips_before = dict((name, list(value)) for name, value in storage.stats.items())
+
+    def pick():
+        at = rand.uniform(0, total_weight)
+        for name, weight in mix:
+            at -= weight
+            if at <= 0:
+                return name
+        return mix[-1][0]
+
+    def deliver(i):
+        kind = pick()
+        user = 'user{}'.format(i % options.users)
+        if kind == 'chat':
+            channel = channels[i % len(channels)]
+            text = ' '.join(bench.WORDS[i % 7:])
+            reactor.callFromThread(channel.showGroupMessage, user, text)
+            return
+        probe = Probe(kind)
+        probes.append(probe)
+        text = COMMANDS[kind](i)
+        if rand.random() < options.private:
+            conversation = private_class(FakePerson(user), chatui, probe)
+            probe.sent = time.time()
+            reactor.callFromThread(conversation.showMessage, text)
+        else:
+            conversation = group_class(bench.FakeGroup('#load{}'.format(i)), chatui, probe)
+            probe.sent = time.time()
+            reactor.callFromThread(conversation.showGroupMessage, user, text)
+
+    def sample():
+        while not done.is_set():
+            peak_threads[0] = max(peak_threads[0], threading.active_count())
+            time.sleep(0.05)
+
+    bench.start_reactor()
+    done = threading.Event()
+    sampler = threading.Thread(target=sample)
+    sampler.daemon = True
+    sampler.start()
+
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        started = time.time()
+        sent = 0
+        while True:
+            elapsed = time.time() - started
+            if elapsed >= options.duration:
+                break
+            due = int(elapsed * options.rate)
+            while sent < due:
+                deliver(sent)
+                sent += 1
+            time.sleep(0.001)
+        sending = time.time() - started
+        deadline = time.time() + options.drain
+        while time.time() < deadline and any(probe.first is None for probe in probes):
+            time.sleep(0.01)
+        done.set()
+    finally:
+        # let the log writer finish with the stand-in stdout before it goes away
+        logger._writer.queue.join()
+        sys.stdout.close()
+        sys.stdout = stdout
+        if process is not None:
+            process.terminate()
+
+    answered = [probe for probe in probes if probe.first is not None and not probe.rejected]
+    by_command = {}
+    for kind in sorted(set(probe.kind for probe in probes)):
+        by_command[kind] = percentiles([probe.first - probe.sent for probe in answered if probe.kind == kind])
+    round_trips = {}
+    for name, (requests, trips) in storage.stats.items():
+        before = round_trips_before.get(name, [0, 0])
+        if requests > before[0]:
+            round_trips[name] = round(float(trips - before[1]) / (requests - before[0]), 2)
+    return {
+        'commit': commit(),
+        'config': {
+            'rate': options.rate,
+            'duration': options.duration,
+            'mix': options.mix,
+            'users': options.users,
+            'private': options.private,
+            'redis': options.redis,
+            'throttle': options.throttle,
+            'workers': getattr(settings, 'executor_workers', 4),
+        },
+        'messages': sent,
+        'messages_per_sec': round(sent / sending, 1),
+        'commands': len(probes),
+        'answered': len(answered),
+        'rejected': sum(1 for probe in probes if probe.rejected),
+        'unanswered': sum(1 for probe in probes if probe.first is None),
+        'latency_ms': percentiles([probe.first - probe.sent for probe in answered]),
+        'latency_ms_by_command': by_command,
+        'peak_threads': peak_threads[0],
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'redis_round_trips_per_command': round_trips,
+        'executor_depth_at_end': executor.shared().depth,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--rate', type=float, default=100, help='messages per second')
+    parser.add_argument('--duration', type=float, default=10, help='seconds of traffic')
+    parser.add_argument('--mix', default='chat=80,echo=8,dice=4,list=4,usage=2,test=2', help='name=weight,...')
+    parser.add_argument('--users', type=int, default=50, help='distinct senders')
+    parser.add_argument('--private', type=float, default=0.1, help='share of commands sent as private messages')
+    parser.add_argument('--redis', choices=('fake', 'server', 'settings'), default='fake',
+                        help='in-process stand-in, a throwaway local redis-server, or the one in settings')
+    parser.add_argument('--throttle', action='store_true', help='keep the configured flood control')
+    parser.add_argument('--workers', type=int, default=None, help='command executor threads')
+    parser.add_argument('--drain', type=float, default=10, help='seconds to wait for outstanding commands')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=None, help='write the JSON report here instead of stdout')
+    options = parser.parse_args()
+    report = json.dumps(run(options), indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as out:
+            out.write(report + '\n')
+    else:
+        print report
+    os._exit(0)
+
+
+if __name__ == '__main__':
+    main()
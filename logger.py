@@ -1,8 +1,12 @@
 import os
+import sys
 import time
+import Queue
 import atexit
+import events
 import settings
 import termcolor
+import threading
 
 
 HOME_DIR = os.getenv('HOME')
@@ -12,37 +16,209 @@ LOG_FILE = getattr(
     'log_file',
     os.path.join(LOG_DIR, '{}.log'.format(settings.redis_prefix)),
 )
-LOG_FILE_OBJ = None
+_stamp = [None, None]
 
 
-def close_log_file():
-    LOG_FILE_OBJ.close()
+def timestamp(now=None):
+    now = int(now if now is not None else time.time())
+    if now != _stamp[0]:
+        _stamp[:] = [now, time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(now))]
+    return _stamp[1]
 
 
-def log(strings, colors):
-    t = time.strftime('%Y-%m-%d %H:%M:%S')
-    out = '[{}] '.format(termcolor.colored(t, 'cyan'))
+def chat(nick, channel, text):
+    """log() for plain chatter, never colored so busy channels stay cheap."""
+    _writer.put(('chat', time.time(), (nick, channel, text)))
+
+
+def log(strings, colors, event=None):
+    """event, if given, is (kind, nick, channel, text) for the structured event log."""
+    _writer.put(('log', time.time(), (strings, colors, event)))
+
+
+def format_chat(when, nick, channel, text):
+    if channel:
+        return '[{}] <{}/{}> {}'.format(timestamp(when), nick, channel, text)
+    return '[{}] <{}> {}'.format(timestamp(when), nick, text)
+
+
+def format_log(when, strings, colors, color):
+    t = timestamp(when)
+    out = '[{}] '.format(termcolor.colored(t, 'cyan')) if color else None
     out_simple = '[{}] '.format(t)
     colors = list(colors)
     while len(colors) % 2:
         colors.append(None)
     for s, c in zip(strings, colors):
+        if isinstance(s, unicode):
+            s = s.encode('utf-8')
         if c:
-            out += termcolor.colored(s, c[0], **c[1])
+            if color:
+                out += termcolor.colored(s, c[0], **c[1])
             try:
                 out_simple += s
             except TypeError:
                 out_simple += repr(s)
         else:
-            out += s
+            if color:
+                out += s
             out_simple += s
-    print out
-    if LOG_FILE_OBJ:
-        LOG_FILE_OBJ.write('{}\n'.format(out_simple))
-        LOG_FILE_OBJ.flush()
-
-if getattr(settings, 'file_logging', False):
-    if 'log' not in os.listdir(HOME_DIR):
-        os.makedirs(LOG_DIR)
-    LOG_FILE_OBJ = open(LOG_FILE, 'a')
-    atexit.register(close_log_file)
+    return out if color else out_simple, out_simple
+
+
+class Writer(object):
+    """Formats and writes records on its own thread, flushing by size or age and rotating the file.
+
+    Callers only put a tuple on a queue; when the queue is full records are
+    dropped and counted rather than blocking the reactor.
+    """
+
+    def __init__(self, path=None, flush_bytes=65536, flush_interval=1.0,
+                 rotate_bytes=0, rotate_interval=0, rotate_keep=7, queue_size=100000, events=None):
+        self.path = path
+        self.events = events
+        self.flush_bytes = flush_bytes
+        self.flush_interval = flush_interval
+        self.rotate_bytes = rotate_bytes
+        self.rotate_interval = rotate_interval
+        self.rotate_keep = rotate_keep
+        self.queue = Queue.Queue(queue_size)
+        self.dropped = 0
+        self.file = None
+        self.opened = None
+        self.buffered = 0
+        self.flushed = time.time()
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def put(self, record):
+        if self.thread is None:
+            with self.lock:
+                if self.thread is None:
+                    self.start()
+        try:
+            self.queue.put_nowait(record)
+        except Queue.Full:
+            self.dropped += 1
+
+    def start(self):
+        if self.path:
+            self.open()
+        self.thread = threading.Thread(target=self.run, name='logger')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def open(self):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.file = open(self.path, 'a')
+        self.opened = time.time()
+
+    def run(self):
+        while True:
+            timeout = max(self.flush_interval - (time.time() - self.flushed), 0.01)
+            try:
+                records = [self.queue.get(timeout=timeout)]
+            except Queue.Empty:
+                records = []
+            # take whatever else is already waiting so it goes out in one write
+            while len(records) < 1000:
+                try:
+                    records.append(self.queue.get_nowait())
+                except Queue.Empty:
+                    break
+            stop = None in records
+            try:
+                self.write([record for record in records if record is not None])
+                if stop or self.buffered >= self.flush_bytes or time.time() - self.flushed >= self.flush_interval:
+                    self.flush()
+            except (IOError, OSError, ValueError):
+                # a closed stdout or full disk must not kill the writer
+                self.buffered = 0
+                self.flushed = time.time()
+            for _ in records:
+                self.queue.task_done()
+            if stop:
+                return
+
+    def write(self, records):
+        if self.dropped:
+            dropped, self.dropped = self.dropped, 0
+            records.append(('chat', time.time(), ('logger', None, 'dropped {} records, queue full'.format(dropped))))
+        if not records:
+            return
+        color = sys.stdout.isatty()
+        shown = []
+        plain = []
+        structured = []
+        for kind, when, payload in records:
+            if kind == 'chat':
+                line = format_chat(when, *payload)
+                shown.append(line)
+                plain.append(line)
+                if payload[1]:
+                    structured.append((when, 'msg') + payload)
+            else:
+                out, out_simple = format_log(when, payload[0], payload[1], color)
+                shown.append(out)
+                plain.append(out_simple)
+                if payload[2]:
+                    structured.append((when,) + payload[2])
+        if self.events is not None and structured:
+            self.events.append(structured)
+        sys.stdout.write('\n'.join(shown) + '\n')
+        if self.file is not None:
+            data = '\n'.join(plain) + '\n'
+            self.file.write(data)
+            self.buffered += len(data)
+
+    def flush(self):
+        sys.stdout.flush()
+        if self.file is not None:
+            self.file.flush()
+            self.rotate()
+        if self.events is not None:
+            self.events.flush()
+        self.buffered = 0
+        self.flushed = time.time()
+
+    def rotate(self):
+        too_big = self.rotate_bytes and self.file.tell() >= self.rotate_bytes
+        too_old = self.rotate_interval and time.time() - self.opened >= self.rotate_interval
+        if not (too_big or too_old):
+            return
+        self.file.close()
+        os.rename(self.path, '{}.{}'.format(self.path, time.strftime('%Y%m%d-%H%M%S')))
+        self.open()
+        directory = os.path.dirname(self.path) or '.'
+        prefix = os.path.basename(self.path) + '.'
+        rotated = sorted(name for name in os.listdir(directory) if name.startswith(prefix))
+        for name in rotated[:-self.rotate_keep] if self.rotate_keep else []:
+            os.remove(os.path.join(directory, name))
+
+    def stop(self):
+        if self.thread is not None and self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        if self.file is not None:
+            self.file.close()
+        if self.events is not None:
+            self.events.close()
+
+
+try:
+    _writer
+except NameError:
+    # first import only; plugins.reload_module keeps the running writer
+    _writer = Writer(
+        path=os.path.expanduser(LOG_FILE) if getattr(settings, 'file_logging', False) else None,
+        flush_bytes=getattr(settings, 'log_flush_bytes', 65536),
+        flush_interval=getattr(settings, 'log_flush_interval', 1.0),
+        rotate_bytes=getattr(settings, 'log_rotate_bytes', 0),
+        rotate_interval=getattr(settings, 'log_rotate_interval', 0),
+        rotate_keep=getattr(settings, 'log_rotate_keep', 7),
+        queue_size=getattr(settings, 'log_queue_size', 100000),
+        events=events.shared() if getattr(settings, 'event_logging', False) else None,
+    )
+    atexit.register(_writer.stop)
@@ -0,0 +1,288 @@
+import os
+import time
+import bisect
+import logger
+import storage
+import settings
+import threading
+import collections
+
+# histogram bucket upper bounds in seconds; one more bucket catches the rest
+BOUNDS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0,
+)
+# handler includes the auth, redis and http time spent inside it; total is queue + parse + handler
+PHASES = ('queue', 'parse', 'auth', 'handler', 'redis', 'http', 'total')
+NAMESPACE = 'zonkb0t'
+# finished commands wait this many at most before a command thread files them
+FOLD_AT = 1024
+
+
+class Histogram(object):
+    __slots__ = ('counts', 'sum', 'count')
+
+    def __init__(self):
+        self.counts = [0] * (len(BOUNDS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        """Not locked: callers observe from one thread or hold a lock."""
+        self.counts[bisect.bisect_left(BOUNDS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-th quantile."""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(BOUNDS + (float('inf'),), self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+
+class CommandStats(object):
+    """Histograms per phase of one command.
+
+    Finished commands only append their timings to pending, which needs no
+    lock; fold() files them FOLD_AT at a time, and histogram() folds first.
+    """
+
+    def __init__(self):
+        self.phases = dict((phase, Histogram()) for phase in PHASES)
+        self.errors = 0
+        self.pending = collections.deque()
+        self.lock = threading.Lock()
+
+    def fold(self, wait=True):
+        """File the pending timings; without wait, leave them if another thread holds the lock."""
+        if not self.lock.acquire(wait):
+            return
+        try:
+            # only the lock holder pops, so len() never overstates what is there
+            popleft = self.pending.popleft
+            self.record([popleft() for _ in xrange(len(self.pending))])
+        finally:
+            self.lock.release()
+
+    def record(self, timings, bisect_right=bisect.bisect_right):
+        """File a batch of {phase: seconds}, sorting each phase once rather than bisecting every value.
+
+        Only phases a command touched are filed; the rest are zeros that
+        histogram() fills back in. The caller holds the lock.
+        """
+        if timings:
+            for phase, histogram in self.phases.iteritems():
+                values = sorted([timing[phase] for timing in timings if phase in timing])
+                if not values:
+                    continue
+                counts = histogram.counts
+                below = 0
+                for i, bound in enumerate(BOUNDS):
+                    upto = bisect_right(values, bound)
+                    counts[i] += upto - below
+                    below = upto
+                counts[-1] += len(values) - below
+                histogram.sum += sum(values)
+                histogram.count += len(values)
+
+    def histogram(self, phase):
+        self.fold()
+        with self.lock:
+            histogram = self.phases[phase]
+            filled = Histogram()
+            filled.counts = list(histogram.counts)
+            filled.sum = histogram.sum
+            filled.count = self.phases['total'].count
+            filled.counts[0] += filled.count - histogram.count
+            return filled
+
+
+class Local(threading.local):
+    # the phase timings of the command running on this thread, if any
+    timing = None
+
+
+_local = Local()
+_commands = {}
+_commands_lock = threading.Lock()
+# account name -> OutputScheduler, which has lag (a Histogram) and depth()
+outputs = {}
+
+
+def stats(name):
+    entry = _commands.get(name)
+    if entry is None:
+        with _commands_lock:
+            entry = _commands.setdefault(name, CommandStats())
+    return entry
+
+
+def add(phase, seconds):
+    """Charge seconds to phase of the command running on this thread, if any."""
+    timing = _local.timing
+    if timing is not None:
+        timing[phase] = timing.get(phase, 0.0) + seconds
+
+
+# classes rather than contextlib generators: they cost a fraction as much per use
+class timed(object):
+    """add() the time inside to phase; outside a command it doesn't read the clock."""
+    __slots__ = ('phase', 'timing', 'start')
+
+    def __init__(self, phase):
+        self.phase = phase
+
+    def __enter__(self):
+        self.timing = _local.timing
+        if self.timing is not None:
+            self.start = time.time()
+
+    def __exit__(self, *exc_info):
+        timing = self.timing
+        if timing is not None:
+            timing[self.phase] = timing.get(self.phase, 0.0) + time.time() - self.start
+
+
+class command(object):
+    """Time one command; phases are charged with timed() and add() from inside it.
+
+    Leaving only queues the timings on the CommandStats; they are filed
+    FOLD_AT at a time, by the command thread that fills the queue or by
+    whoever reads the stats first.
+    """
+    __slots__ = ('name', 'timing', 'start')
+
+    def __init__(self, name, queue=0.0, parse=0.0):
+        self.name = name
+        self.timing = {'queue': queue, 'parse': parse}
+
+    def __enter__(self):
+        _local.timing = self.timing
+        self.start = time.time()
+        return self.timing
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        timing = self.timing
+        _local.timing = None
+        timing['total'] = timing['queue'] + timing['parse'] + time.time() - self.start
+        entry = _commands.get(self.name) or stats(self.name)
+        if exc_type is not None:
+            with entry.lock:
+                entry.errors += 1
+        pending = entry.pending
+        pending.append(timing)
+        # one thread files the batch; the others carry on rather than wait for it
+        if len(pending) >= FOLD_AT:
+            entry.fold(wait=False)
+
+
+#### REPORTING
+
+def ms(seconds):
+    if seconds is None:
+        return '-'
+    if seconds == float('inf'):
+        return '>{:g}'.format(BOUNDS[-1] * 1000)
+    if seconds == BOUNDS[0]:
+        return '<{:g}'.format(BOUNDS[0] * 1000)
+    return '{:g}'.format(seconds * 1000)
+
+
+def summary():
+    """One line per command, busiest first, with bucketed percentiles in ms."""
+    for entry in _commands.values():
+        entry.fold()
+    lines = []
+    for name, entry in sorted(_commands.items(), key=lambda item: -item[1].phases['total'].count):
+        total = entry.histogram('total')
+        requests, round_trips = storage.stats.get(name, (0, 0))
+        lines.append('{}: {} runs {} errors, total p50/p95/p99 {}/{}/{}ms, p95 {}, {:.1f} redis round trips'.format(
+            name,
+            total.count,
+            entry.errors,
+            ms(total.quantile(0.5)),
+            ms(total.quantile(0.95)),
+            ms(total.quantile(0.99)),
+            ' '.join('{} {}'.format(phase, ms(entry.histogram(phase).quantile(0.95))) for phase in PHASES[:-1]),
+            float(round_trips) / requests if requests else 0,
+        ))
+    for name, scheduler in sorted(outputs.items()):
+        lines.append('output {}: {} lines queued, send lag p50/p95/p99 {}/{}/{}ms'.format(
+            name,
+            scheduler.depth(),
+            ms(scheduler.lag.quantile(0.5)),
+            ms(scheduler.lag.quantile(0.95)),
+            ms(scheduler.lag.quantile(0.99)),
+        ))
+    return '\n'.join(lines) or 'No commands yet.'
+
+
+def label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def histogram_lines(metric, labels, histogram):
+    seen = 0
+    for bound, count in zip(BOUNDS + (float('inf'),), histogram.counts):
+        seen += count
+        le = '+Inf' if bound == float('inf') else '{:g}'.format(bound)
+        yield '{}_bucket{{{},le="{}"}} {}'.format(metric, labels, le, seen)
+    yield '{}_sum{{{}}} {!r}'.format(metric, labels, histogram.sum)
+    yield '{}_count{{{}}} {}'.format(metric, labels, histogram.count)
+
+
+def prometheus():
+    """Everything in the Prometheus text exposition format."""
+    lines = ['# TYPE {}_command_seconds histogram'.format(NAMESPACE)]
+    for name, entry in sorted(_commands.items()):
+        for phase in PHASES:
+            labels = 'command="{}",phase="{}"'.format(label(name), phase)
+            lines.extend(histogram_lines(NAMESPACE + '_command_seconds', labels, entry.histogram(phase)))
+    lines.append('# TYPE {}_command_errors_total counter'.format(NAMESPACE))
+    for name, entry in sorted(_commands.items()):
+        lines.append('{}_command_errors_total{{command="{}"}} {}'.format(NAMESPACE, label(name), entry.errors))
+    lines.append('# TYPE {}_redis_round_trips_total counter'.format(NAMESPACE))
+    for name, (requests, round_trips) in sorted(storage.stats.items()):
+        lines.append('{}_redis_round_trips_total{{command="{}"}} {}'.format(NAMESPACE, label(name), round_trips))
+    lines.append('# TYPE {}_output_queue_depth gauge'.format(NAMESPACE))
+    for name, scheduler in sorted(outputs.items()):
+        lines.append('{}_output_queue_depth{{account="{}"}} {}'.format(NAMESPACE, label(name), scheduler.depth()))
+    lines.append('# TYPE {}_output_send_lag_seconds histogram'.format(NAMESPACE))
+    for name, scheduler in sorted(outputs.items()):
+        lines.extend(histogram_lines(NAMESPACE + '_output_send_lag_seconds', 'account="{}"'.format(label(name)), scheduler.lag))
+    return '\n'.join(lines) + '\n'
+
+
+def dump(path):
+    # written beside the target and renamed so a scraper never sees half a file
+    partial = '{}.tmp'.format(path)
+    try:
+        with open(partial, 'w') as out:
+            out.write(prometheus())
+        os.rename(partial, path)
+    except (IOError, OSError) as e:
+        # keep the LoopingCall going; the next interval may succeed
+        logger.log(
+            ('-!- METRICS DUMP FAILED -!- ', ': ', str(e)),
+            (settings.cd['e'], None, settings.cd['e']),
+        )
+
+
+_dumper = None
+
+
+def start_dump():
+    """Rewrite settings.metrics_file every metrics_interval seconds, if set. Reactor only."""
+    global _dumper
+    path = getattr(settings, 'metrics_file', None)
+    if not path or _dumper is not None:
+        return
+    from twisted.internet import task
+    _dumper = task.LoopingCall(dump, os.path.expanduser(path))
+    _dumper.start(getattr(settings, 'metrics_interval', 15), now=False)
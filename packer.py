@@ -0,0 +1,38 @@
+MAX_LINE = 512
+# room for the ':nick!user@host ' prefix the server adds when relaying
+PREFIX_RESERVE = 100
+
+
+def budget(target):
+    """Bytes of text that fit in one PRIVMSG to target."""
+    return MAX_LINE - len('\r\n') - len('PRIVMSG {} :'.format(target)) - PREFIX_RESERVE
+
+
+def pack(text, budget):
+    """Yield utf-8 messages of at most budget bytes.
+
+    Lines are kept apart, long lines break on the last space that leaves the
+    message at least half full, otherwise right before a utf-8 lead byte.
+    """
+    if isinstance(text, unicode):
+        text = text.encode('utf-8')
+    half = budget // 2
+    for line in text.split('\n'):
+        line = line.rstrip('\r')
+        start, end = 0, len(line)
+        while end - start > budget:
+            limit = start + budget
+            cut = line.rfind(' ', start + half, limit + 1)
+            if cut != -1:
+                yield line[start:cut]
+                start = cut + 1
+                continue
+            cut = limit
+            while cut > start and '\x80' <= line[cut] < '\xc0':
+                cut -= 1
+            if cut == start:
+                cut = limit
+            yield line[start:cut]
+            start = cut
+        if start < end:
+            yield line[start:]
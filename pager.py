@@ -0,0 +1,102 @@
+import packer
+import storage
+import settings
+
+
+class Pager(object):
+    """Splits one command's output into pages; the first is sent, the rest wait in redis for %more.
+
+    Pages live in a list per user and target that expires after ttl seconds,
+    so only a page at a time is ever held in memory or queued for sending.
+    """
+    REDIS_SEG = 'more'
+
+    r = storage.client
+
+    def __init__(self, username, target, page_lines=15, page_bytes=2000, max_pages=100, ttl=600):
+        self.username = username
+        self.target = target
+        self.page_lines = page_lines
+        self.page_bytes = page_bytes
+        self.max_pages = max_pages
+        self.ttl = ttl
+        # lines and bytes on the page being filled; only pages after the first are buffered
+        self.lines = 0
+        self.size = 0
+        self.buffer = []
+        self.pages = 0
+        self.stored = 0
+        self.dropped = False
+
+    @classmethod
+    def for_user(cls, username, target):
+        return cls(
+            username,
+            target,
+            page_lines=getattr(settings, 'more_page_lines', 15),
+            page_bytes=getattr(settings, 'more_page_bytes', 2000),
+            max_pages=getattr(settings, 'more_max_pages', 100),
+            ttl=getattr(settings, 'more_ttl', 600),
+        )
+
+    @property
+    def key(self):
+        return '{}:{}:{}:{}'.format(settings.redis_prefix, self.REDIS_SEG, self.username, self.target)
+
+    def fits(self, line):
+        if not self.lines:
+            return True
+        return self.lines < self.page_lines and self.size + len(line) + 1 <= self.page_bytes
+
+    def write(self, text):
+        """Add output; returns the part of it that is on the first page and should be sent now."""
+        send = []
+        for line in self.lines_of(text):
+            if not self.fits(line):
+                self.end_page()
+            self.lines += 1
+            self.size += len(line) + 1
+            if self.pages:
+                self.buffer.append(line)
+            else:
+                send.append(line)
+        return '\n'.join(send)
+
+    def lines_of(self, text):
+        """text's lines, those too long for a page broken up so no page is ever larger than page_bytes."""
+        for line in text.split('\n'):
+            if len(line) < self.page_bytes:
+                yield line
+            else:
+                for piece in packer.pack(line, self.page_bytes - 1):
+                    yield piece
+
+    def end_page(self):
+        if self.buffer:
+            if self.stored >= self.max_pages:
+                self.dropped = True
+            else:
+                with storage.deferred() as pipe:
+                    if not self.stored:
+                        # a new long output replaces whatever was left of the last one
+                        pipe.delete(self.key)
+                    pipe.rpush(self.key, '\n'.join(self.buffer))
+                    pipe.expire(self.key, self.ttl)
+                self.stored += 1
+        self.pages += 1
+        self.lines = 0
+        self.size = 0
+        self.buffer = []
+
+    def close(self):
+        """Store the last partial page; returns how many pages wait for %more."""
+        self.end_page()
+        return self.stored
+
+    def next(self):
+        """(next stored page or None, pages left after it)."""
+        pipe = self.r.pipeline(transaction=False)
+        pipe.lpop(self.key)
+        pipe.llen(self.key)
+        page, left = pipe.execute()
+        return page, left
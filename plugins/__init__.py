@@ -0,0 +1,106 @@
+"""Command handlers that live outside botcommand so their imports wait for first use.
+
+REGISTRY maps handler names, the values in BotCommand.cmd_map, to the plugin
+module defining them.  A plugin is imported the first time one of its
+handlers is looked up and can be reloaded alone with reload_plugin(), which
+first reloads the top-level modules in BACKING that hold the plugin's logic.
+Handlers are plain functions taking the BotCommand and its args.
+
+A reloaded module keeps its singletons (SINGLETONS, e.g. the procmon thread,
+the weather refresher and the database pool): the running instance is carried
+over and moved onto the reloaded class of the same name, so edited methods
+take effect without losing caches, threads or connections.  Edits to
+__init__ only apply to instances made after a restart.
+"""
+
+import sys
+import importlib
+
+REGISTRY = {
+    '_client'          : 'accounts',
+    '_join'            : 'accounts',
+    '_leave'           : 'accounts',
+    '_status'          : 'accounts',
+    '_dice'            : 'dice',
+    '_dice_dist'       : 'dice',
+    '_grep'            : 'events',
+    '_seen'            : 'events',
+    '_list'            : 'lists',
+    '_list_add'        : 'lists',
+    '_list_del'        : 'lists',
+    '_list_key'        : 'lists',
+    '_list_random'     : 'lists',
+    '_list_show'       : 'lists',
+    '_mysql'           : 'mysql',
+    '_ps'              : 'ps',
+    '_reddit'          : 'reddit',
+    '_run'             : 'run',
+    '_stats'           : 'stats',
+    '_url'             : 'url',
+    '_weather'         : 'weather',
+    '_weather_raw'     : 'weather',
+}
+
+# top-level modules holding each plugin's logic, reloaded before it
+BACKING = {
+    'dice'             : ('dice',),
+    'events'           : ('events',),
+    'mysql'            : ('database',),
+    'ps'               : ('procmon',),
+    'reddit'           : ('reddit',),
+    'run'              : ('runner',),
+    'url'              : ('fetch',),
+    'weather'          : ('weather',),
+}
+
+SINGLETONS = ('_shared', '_writer')
+
+
+def names():
+    return sorted(set(REGISTRY.itervalues()))
+
+
+def module_name(plugin):
+    return '{}.{}'.format(__name__, plugin)
+
+
+def module(plugin):
+    """The plugin module, imported now if this is its first use."""
+    return sys.modules.get(module_name(plugin)) or importlib.import_module(module_name(plugin))
+
+
+def handler(name):
+    plugin = REGISTRY.get(name)
+    if plugin is None:
+        return None
+    return getattr(module(plugin), name, None)
+
+
+def loaded():
+    return [plugin for plugin in names() if module_name(plugin) in sys.modules]
+
+
+def reload_module(module):
+    """reload(module), carrying its SINGLETONS over onto the reloaded classes."""
+    kept = dict((name, getattr(module, name)) for name in SINGLETONS if getattr(module, name, None) is not None)
+    reload(module)
+    for name, instance in kept.iteritems():
+        cls = getattr(module, type(instance).__name__, None)
+        if isinstance(cls, type) and cls is not type(instance):
+            try:
+                instance.__class__ = cls
+            except TypeError:
+                # __slots__ changed; the old class keeps serving until a restart
+                pass
+        setattr(module, name, instance)
+
+
+def reload_plugin(plugin):
+    """Re-run one plugin's source and its BACKING modules; everything else, cmd_map and queued output
+    included, is untouched."""
+    for name in BACKING.get(plugin, ()):
+        reload_module(sys.modules.get(name) or importlib.import_module(name))
+    if module_name(plugin) in sys.modules:
+        reload(sys.modules[module_name(plugin)])
+    else:
+        module(plugin)
@@ -0,0 +1,58 @@
+from __future__ import absolute_import
+
+import auth
+import settings
+
+
+@auth.requires_login(user_level=auth.SessionManager.GOD_USER)
+def _client(bc, args):
+    if not args:
+        return None
+    for account in settings.accounts:
+        try:
+            return repr(getattr(account, args[0])(*args[1:]))
+        except TypeError:
+            return repr(getattr(account, args[0]))
+        except AttributeError:
+            return repr(dir(account))
+
+
+@auth.requires_login(user_level=auth.SessionManager.TRUSTED_USER)
+def _join(bc, args):
+    for arg in args:
+        chan = '{}{}'.format('#' if not arg.startswith('#') else '', arg)
+        print chan
+        for account in settings.accounts:
+            account.client.joinGroup(chan)
+
+
+@auth.requires_login(user_level=auth.SessionManager.TRUSTED_USER)
+def _leave(bc, args):
+    args = args if args else [bc.groupname]
+    if not args:
+        args = [] if not bc.groupname else [bc.groupname]
+    for arg in args:
+        chan = '{}{}'.format('#' if not arg.startswith('#') else '', arg)
+        for account in settings.accounts:
+            account.client.leave(chan)
+
+
+@auth.requires_login(user_level=auth.SessionManager.BASIC_USER)
+def _status(bc, args):
+    output = []
+    for arg in args:
+        for account in settings.accounts:
+            person = account.client.getPerson(arg)
+            if person:
+                # print dir(person)
+                output.append('Idle:{}  Commands:{}  Status:{}  IMP_W:{}  Online:{}'.format(
+                    repr(person.getIdleTime()),
+                    repr(person.getPersonCommands()),
+                    repr(person.getStatus()),
+                    repr(person.imperson_whois()),
+                    repr(person.isOnline()),
+                ))
+            else:
+                output.append('Person {} not found.'.format(repr(bc.username)))
+                # import ipdb; ipdb.set_trace() # BREAKPOINT
+    return '\n'.join(output)
@@ -0,0 +1,30 @@
+from __future__ import absolute_import
+
+import dice
+
+
+def _dice(bc, args):
+    """Usage: `{cmd_prefix}dice [dist] *args` with args like 1d6, 4d6dl1+2, 2d20kh1, 3d6*10 -- 1d6 is default"""
+    if args and args[0] == 'dist':
+        return _dice_dist(bc, args[1:])
+    if not args:
+        args = ['1d6']
+    output = []
+    for group in args:
+        try:
+            total, rolls = dice.roll(group)
+        except dice.DiceError as e:
+            output.append(str(e))
+            continue
+        output.append('group {} had sum {} with rolls {}'.format(group, total, rolls))
+    return '\n'.join(output)
+
+
+def _dice_dist(bc, args):
+    output = []
+    for group in args or ['1d6']:
+        try:
+            output.append('{}: {}'.format(group, dice.describe(dice.distribution(group))))
+        except dice.DiceError as e:
+            output.append(str(e))
+    return '\n'.join(output)
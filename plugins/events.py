@@ -0,0 +1,79 @@
+from __future__ import absolute_import
+
+import re
+import time
+import auth
+import events
+import settings
+
+SINCE = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+
+
+def _seen(bc, args):
+    """Usage: `{cmd_prefix}seen nick`"""
+    if not args:
+        return None
+    nick = args[0]
+    log = events.shared()
+    for event in log.backward(events.needle('n', nick), getattr(settings, 'events_scan_bytes', 2 ** 26)):
+        return '{} was last seen {} ago in {} {}'.format(
+            nick, ago(event['t']), event['c'].encode('utf-8'), action(event))
+    return "Haven't seen {}.".format(nick)
+
+
+def ago(when):
+    seconds = max(int(time.time() - when), 0)
+    parts = []
+    for unit, width in (('d', 86400), ('h', 3600), ('m', 60), ('s', 1)):
+        if seconds >= width or (width == 1 and not parts):
+            parts.append('{}{}'.format(seconds // width, unit))
+            seconds %= width
+    return ' '.join(parts[:2])
+
+
+def action(event):
+    text = event['x'].encode('utf-8')
+    return {
+        'msg': 'saying: {}',
+        'topic': 'setting the topic to: {}',
+        'join': 'joining{}',
+        'leave': 'leaving{}',
+        'nick': 'changing nick to {}',
+    }.get(event['k'], event['k'] + ' {}').format(text)
+
+
+@auth.requires_login(user_level=auth.SessionManager.BASIC_USER)
+def _grep(bc, args):
+    """Usage: `{cmd_prefix}grep pattern [#channel] [since like 30m, 2h or 7d -- 1d is default]`"""
+    channel = bc.groupname
+    since = 86400
+    words = []
+    for arg in args:
+        if arg.startswith('#'):
+            channel = arg
+        elif re.match(r'^\d+[smhdw]$', arg):
+            since = int(arg[:-1]) * SINCE[arg[-1]]
+        else:
+            words.append(arg)
+    if not words:
+        return None
+    try:
+        pattern = re.compile(' '.join(words), re.I | re.U)
+    except re.error:
+        pattern = re.compile(re.escape(' '.join(words)), re.I | re.U)
+    limit = getattr(settings, 'grep_max_results', 100)
+    needle = events.needle('c', channel) if channel else None
+    output = []
+    for event in events.shared().forward(time.time() - since, needle, getattr(settings, 'events_scan_bytes', 2 ** 26)):
+        if event['k'] not in ('msg', 'topic') or not pattern.search(event['x']):
+            continue
+        output.append('[{}] <{}/{}> {}'.format(
+            time.strftime('%Y-%m-%d %H:%M', time.localtime(event['t'])),
+            event['n'].encode('utf-8'),
+            event['c'].encode('utf-8'),
+            event['x'].encode('utf-8'),
+        ))
+        if len(output) >= limit:
+            output.append('Stopped at {} matches.'.format(limit))
+            break
+    return '\n'.join(output) or 'No matches.'
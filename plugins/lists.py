@@ -0,0 +1,92 @@
+from __future__ import absolute_import
+
+import random
+import storage
+import settings
+
+SHOW_COUNT = 50
+
+
+def _list(bc, args):
+    """Usage: `{cmd_prefix}list [add|show|random|del] list_name`"""
+    output = ""
+    list_map = {
+        'add'    : _list_add,
+        'show'   : _list_show,
+        'random' : _list_random,
+        'del'    : _list_del,
+    }
+
+    if not args:
+        return None
+
+    list_cmd = args.pop(0)
+    if list_cmd in list_map:
+        output = list_map[list_cmd](bc, args)
+    return output
+
+
+def _list_add(bc, args):
+    if not args:
+        return None
+    name = args.pop(0)
+    if not args:
+        return None
+    return str(storage.client.lpush(_list_key(bc, name), *args))
+
+
+def _list_show(bc, args):
+    """`show name [start [count]]` pages one list oldest first, `show name name ...` shows several"""
+    if not args:
+        return None
+    numbers = []
+    while len(args) > 1 and args[-1].isdigit() and len(numbers) < 2:
+        numbers.insert(0, int(args.pop()))
+    start = numbers[0] if numbers else 0
+    count = numbers[1] if len(numbers) > 1 else SHOW_COUNT
+    pipe = storage.client.pipeline(transaction=False)
+    for name in args:
+        # lpush puts the newest first, so oldest first counts back from the end
+        pipe.lrange(_list_key(bc, name), -(start + count), -(start + 1))
+        pipe.llen(_list_key(bc, name))
+    results = pipe.execute()
+    output = []
+    more = []
+    for name, items, length in zip(args, results[::2], results[1::2]):
+        output.extend(items[::-1])
+        if start + count < length:
+            more.append('{} has {} items, next: `{}list show {} {} {}`'.format(
+                name, length, bc.CMD_PREFIX, name, start + count, count))
+    return '\n'.join([str(output)] + more)
+
+
+def _list_random(bc, args):
+    if not args:
+        return None
+    keys = [_list_key(bc, name) for name in args]
+    pipe = storage.client.pipeline(transaction=False)
+    for key in keys:
+        pipe.llen(key)
+    lengths = pipe.execute()
+    for key, length in zip(keys, lengths):
+        pipe.lindex(key, random.randint(0, length - 1) if length else 0)
+    output = [item if item is not None else '' for item in pipe.execute()]
+    if len(output) == 1:
+        return str(output[0])
+    return str(output)
+
+
+def _list_del(bc, args):
+    if not args:
+        return None
+    pipe = storage.client.pipeline(transaction=False)
+    for name in args:
+        pipe.delete(_list_key(bc, name))
+    output = pipe.execute()
+    if len(output) == 1:
+        return str(output[0])
+    return str(output)
+
+
+def _list_key(bc, name):
+    return '{}:{}:{}'.format(settings.redis_prefix, 'list', name)
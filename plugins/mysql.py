@@ -0,0 +1,32 @@
+from __future__ import absolute_import
+
+import auth
+import database
+import botcommand
+
+
+@auth.requires_login(user_level=auth.SessionManager.GOD_USER)
+def _mysql(bc, args):
+    """Usage: `{cmd_prefix}mysql DB Query [DB Query, ...]`"""
+    output = []
+    # only one stream per user and target can wait for %more, so only the last query's is kept
+    kept = None
+    for db, query in botcommand.n_at_a_time(args, 2):
+        try:
+            stream = database.shared().execute(db, query)
+            if not stream.columns:
+                output.append('{} rows affected.'.format(stream.rowcount))
+                continue
+            bc.throttler.enqueue(stream.page())
+        except database.DatabaseError as e:
+            output.append('Failed on query {}: {}'.format(repr(query), e))
+            continue
+        if not stream.done:
+            if kept is not None:
+                kept[1].close()
+                output.append('More rows of {} not kept; only the last query can continue.'.format(repr(kept[0])))
+            kept = (query, stream)
+    if kept is not None:
+        database.shared().keep((bc.username, bc.groupname), kept[1])
+        output.append('More rows of {}: `{}more`'.format(repr(kept[0]), bc.CMD_PREFIX))
+    return '\n'.join(output)
@@ -0,0 +1,37 @@
+from __future__ import absolute_import
+
+import auth
+import time
+import procmon
+import settings
+
+
+@auth.requires_login(user_level=auth.SessionManager.BASIC_USER)
+def _ps(bc, args):
+    """Usage: `{cmd_prefix}ps [top N] [by cpu|mem|io] [user name] [name]` -- top 10 by cpu by default"""
+    count = 10
+    by = 'cpu'
+    user = None
+    name = None
+    args = list(args)
+    while args:
+        arg = args.pop(0)
+        if arg == 'top' and args and args[0].isdigit():
+            count = int(args.pop(0))
+        elif arg == 'by' and args:
+            by = args.pop(0)
+            if by not in procmon.KEYS:
+                return 'Sort by {}.'.format(', '.join(procmon.KEYS))
+        elif arg == 'user' and args:
+            user = args.pop(0)
+        else:
+            name = arg
+    count = max(1, min(count, getattr(settings, 'ps_max_lines', 20)))
+    snapshot = procmon.shared().latest()
+    if snapshot is None:
+        return 'No process sample yet, try again in a moment.'
+    found = snapshot.top(count, by, name=name, user=user)
+    output = ['{} of {} processes by {}, sampled {:.0f}s ago'.format(
+        len(found), snapshot.count, by, time.time() - snapshot.taken)]
+    output.extend(procmon.line(proc, snapshot.memory) for proc in found)
+    return '\n'.join(output)
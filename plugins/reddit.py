@@ -0,0 +1,13 @@
+from __future__ import absolute_import
+
+import reddit
+
+
+def _reddit(bc, args):
+    """Usage: `{cmd_prefix}reddit [*subreddits]`"""
+    args = args if args else ['']
+    posts, failed = reddit.shared().top(args)
+    output = ['{}: {} {}'.format(i + 1, post.title, post.url) for i, post in enumerate(posts)]
+    for subreddit, why in failed:
+        output.append('Failed to fetch {}: {}'.format('r/{}'.format(subreddit) if subreddit else 'the front page', why))
+    return '\n'.join(output) or 'No posts.'
@@ -0,0 +1,15 @@
+from __future__ import absolute_import
+
+import auth
+import runner
+
+
+@auth.requires_login(user_level=auth.SessionManager.GOD_USER)
+def _run(bc, args):
+    """Usage: `{cmd_prefix}run cmd`"""
+    if not args:
+        return None
+    run = runner.Run(args, max_bytes=bc.session.output_limit, timeout=bc.session.time_limit)
+    for text in run:
+        bc.output(text)
+    return run.status or ''
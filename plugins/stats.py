@@ -0,0 +1,11 @@
+from __future__ import absolute_import
+
+import auth
+import fetch
+import metrics
+
+
+@auth.requires_login(user_level=auth.SessionManager.GOD_USER)
+def _stats(bc, args):
+    """Usage: `{cmd_prefix}stats` -- per command runs, errors and p95 ms by phase, output queues, fetch cache"""
+    return '\n'.join([metrics.summary(), fetch.shared().stats()])
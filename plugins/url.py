@@ -0,0 +1,20 @@
+from __future__ import absolute_import
+
+import fetch
+
+
+def _url(bc, args):
+    """Usage: `{cmd_prefix}url *urls`"""
+    if not args:
+        return None
+    urls = []
+    for url in args:
+        if not any(url.startswith(i) for i in ('https://', 'http://')):
+            url = 'http://{}'.format(url)
+        urls.append(url)
+    output = []
+    for title in fetch.shared().titles(urls, fetch.ttl('url')):
+        if isinstance(title, fetch.FetchError):
+            title = 'Failed to fetch {}'.format(title)
+        output.append(title)
+    return '\n'.join(output)
@@ -0,0 +1,39 @@
+from __future__ import absolute_import
+
+import fetch
+import weather
+
+
+def _weather(bc, args, raw=False):
+    """Usage: `{cmd_prefix}weather *zip_codes`"""
+    if not args:
+        args = ['92618']
+    output = []
+    for city, result in zip(args, weather.shared().lookup_many(args)):
+        output.append(format_result(city, result, raw=raw))
+    return '\n'.join(output)
+
+
+def format_result(city, result, raw=False):
+    if isinstance(result, fetch.FetchError):
+        return 'Failed to fetch weather for {}'.format(repr(city))
+    if raw:
+        return result.raw
+    if isinstance(result, weather.WeatherError):
+        return 'API error for {}: {}'.format(repr(city), result.raw)
+    return 'Current weather for {city}: {desc}, low:{low:.1f} high:{high:.1f} currently:{cur:.1f}'.format(
+        city=result.name,
+        desc=result.description,
+        low=fahrenheit(result.temp_min),
+        cur=fahrenheit(result.temp),
+        high=fahrenheit(result.temp_max),
+    )
+
+
+def fahrenheit(kelvin):
+    return (kelvin - 273.15) * 1.8 + 32
+
+
+def _weather_raw(bc, args):
+    """Usage: `{cmd_prefix}weather_raw *zip_codes`"""
+    return _weather(bc, args, raw=True)
@@ -0,0 +1,177 @@
+import pwd
+import time
+import logger
+import psutil
+import settings
+import threading
+import traceback
+import collections
+
+KEYS = ('cpu', 'mem', 'io')
+
+# cpu is percent of one core since the previous sample, io is read + write bytes per second
+# (None where the kernel won't say), rss is bytes
+Process = collections.namedtuple('Process', 'pid name user cpu rss io')
+
+
+class Snapshot(object):
+    """One sample of every process, ranked once per sort key so queries only walk the front."""
+
+    def __init__(self, taken, processes, memory):
+        self.taken = taken
+        self.count = len(processes)
+        self.memory = memory
+        self.ranked = {
+            'cpu': sorted(processes, key=lambda proc: proc.cpu, reverse=True),
+            'mem': sorted(processes, key=lambda proc: proc.rss, reverse=True),
+            'io': sorted(processes, key=lambda proc: proc.io if proc.io is not None else -1, reverse=True),
+        }
+
+    def top(self, count, by='cpu', name=None, user=None):
+        """The first count processes by key, matching a name substring and exact user when given."""
+        name = name.lower() if name else None
+        found = []
+        for proc in self.ranked[by]:
+            if name and name not in proc.name.lower():
+                continue
+            if user and proc.user != user:
+                continue
+            found.append(proc)
+            if len(found) >= count:
+                break
+        return found
+
+
+class ProcessMonitor(object):
+    """Samples every process each interval seconds on its own thread; queries read the latest Snapshot.
+
+    The thread starts with the first query and stops after idle seconds without one.
+    """
+
+    def __init__(self, interval=5, idle=600):
+        self.interval = interval
+        self.idle = idle
+        self.snapshot = None
+        # (pid, create time) -> (sampled at, cpu seconds, io bytes) from the last sample
+        self.previous = {}
+        self.users = {}
+        self.asked = 0
+        self.thread = None
+        self.ready = threading.Event()
+        self.lock = threading.Lock()
+
+    def latest(self, wait=10):
+        """The newest Snapshot, waiting up to wait seconds for the first; None if there is none yet."""
+        # under the lock so an idle thread can't stop between this query and its check
+        with self.lock:
+            self.asked = time.time()
+            if self.thread is None:
+                self.start()
+        self.ready.wait(wait)
+        return self.snapshot
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='procmon')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        while True:
+            started = time.time()
+            try:
+                if not self.previous:
+                    # a short first interval so the first answer already has cpu numbers
+                    self.sample()
+                    time.sleep(min(1, self.interval))
+                self.snapshot = self.sample()
+            except Exception:
+                logger.log(
+                    ('-!- PROCESS SAMPLE FAILED -!- ', ': ', traceback.format_exc()),
+                    (settings.cd['e'], None, settings.cd['e']),
+                )
+            self.ready.set()
+            with self.lock:
+                if time.time() - self.asked > self.idle:
+                    self.snapshot = None
+                    self.previous = {}
+                    self.ready.clear()
+                    self.thread = None
+                    return
+            time.sleep(max(0, self.interval - (time.time() - started)))
+
+    def sample(self):
+        now = time.time()
+        previous = self.previous
+        current = {}
+        processes = []
+        for proc in psutil.process_iter():
+            try:
+                with proc.oneshot():
+                    key = (proc.pid, proc.create_time())
+                    name = proc.name()
+                    uid = proc.uids().real
+                    times = proc.cpu_times()
+                    rss = proc.memory_info().rss
+                    try:
+                        counters = proc.io_counters()
+                        io = counters.read_bytes + counters.write_bytes
+                    except psutil.AccessDenied:
+                        io = None
+            except psutil.Error:
+                # gone or not ours to read
+                continue
+            used = times.user + times.system
+            current[key] = (now, used, io)
+            cpu = 0.0
+            rate = None
+            last = previous.get(key)
+            if last is not None and now > last[0]:
+                cpu = max(0.0, (used - last[1]) / (now - last[0]) * 100)
+                if io is not None and last[2] is not None:
+                    rate = max(0.0, (io - last[2]) / (now - last[0]))
+            processes.append(Process(proc.pid, name, self.user(uid), cpu, rss, rate))
+        self.previous = current
+        return Snapshot(now, processes, psutil.virtual_memory().total)
+
+    def user(self, uid):
+        if uid not in self.users:
+            try:
+                self.users[uid] = pwd.getpwuid(uid).pw_name
+            except KeyError:
+                self.users[uid] = str(uid)
+        return self.users[uid]
+
+
+def size(value):
+    for unit in ('', 'K', 'M', 'G'):
+        if value < 1024:
+            return '{:.0f}{}'.format(value, unit)
+        value /= 1024.0
+    return '{:.0f}T'.format(value)
+
+
+def line(proc, memory):
+    return '{:>6} {:<10} cpu {:5.1f}% mem {:>5} {:4.1f}% io {:>5}/s {}'.format(
+        proc.pid,
+        proc.user[:10],
+        proc.cpu,
+        size(proc.rss),
+        100.0 * proc.rss / memory if memory else 0,
+        size(proc.io) if proc.io is not None else '-',
+        proc.name[:32],
+    )
+
+
+_shared = None
+_shared_lock = threading.Lock()
+
+
+def shared():
+    global _shared
+    with _shared_lock:
+        if _shared is None:
+            _shared = ProcessMonitor(
+                interval=getattr(settings, 'ps_interval', 5),
+                idle=getattr(settings, 'ps_idle', 600),
+            )
+        return _shared
@@ -0,0 +1,120 @@
+import json
+import math
+import fetch
+import metrics
+import settings
+import threading
+import webclient
+import collections
+from twisted.internet import reactor, threads
+
+LISTING = 'https://www.reddit.com/{}.json?limit={}'
+LIMIT = 5
+MAX_BYTES = 2 ** 20
+
+Post = collections.namedtuple('Post', ('title', 'url'))
+
+
+class ListingParser(object):
+    """Pull posts out of a listing as its bytes arrive, done after limit posts."""
+    decoder = json.JSONDecoder()
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.buf = ''
+        self.pos = None
+        self.posts = []
+        self.done = False
+
+    def accepts(self, content_type):
+        return 'json' in content_type
+
+    def feed(self, data):
+        self.buf += data
+        if self.pos is None:
+            start = self.buf.find('"children"')
+            bracket = self.buf.find('[', start) if start != -1 else -1
+            if bracket == -1:
+                return
+            self.buf = self.buf[bracket + 1:]
+            self.pos = 0
+        while not self.done:
+            while self.pos < len(self.buf) and self.buf[self.pos] in ' \t\r\n,':
+                self.pos += 1
+            if self.pos >= len(self.buf):
+                break
+            if self.buf[self.pos] == ']':
+                self.done = True
+                break
+            try:
+                child, self.pos = self.decoder.raw_decode(self.buf, self.pos)
+            except ValueError:
+                # not all of this child has arrived yet
+                break
+            data = child.get('data', {})
+            self.posts.append(Post(data.get('title', '').encode('utf-8'), data.get('url', '').encode('utf-8')))
+            self.done = len(self.posts) >= self.limit
+        self.buf = self.buf[self.pos:]
+        self.pos = 0
+
+
+class RedditService(object):
+    """Listings through the shared fetch cache, one entry per subreddit and share."""
+
+    def __init__(self, ttl=60, timeout=10):
+        self.ttl = ttl
+        self.timeout = timeout
+
+    def top(self, subreddits, limit=LIMIT):
+        """(up to limit posts across subreddits, each asked for its share, [(subreddit, why)] for
+        those that could not be fetched). Command threads only."""
+        share = int(math.ceil(float(limit) / len(subreddits)))
+        keys = ['reddit:{}:{}'.format(share, subreddit) for subreddit in subreddits]
+        merged = []
+        failed = []
+        results = fetch.shared().cached_many(keys, self.ttl, lambda items: self.load(items, share))
+        for subreddit, result in zip(subreddits, results):
+            if isinstance(result, Exception):
+                failed.append((subreddit, str(result)))
+            else:
+                merged.extend(Post(title.encode('utf-8'), url.encode('utf-8')) for title, url in json.loads(result))
+        return merged[:limit], failed
+
+    def load(self, items, share):
+        subreddits = [key.split(':', 2)[2] for key, _ in items]
+        with metrics.timed('http'):
+            return threads.blockingCallFromThread(reactor, self.fetch, subreddits, share)
+
+    def fetch(self, subreddits, share):
+        """Deferred list of fetch.Entry holding the posts as json, or FetchError, per subreddit. Reactor only."""
+        requests = [
+            {
+                'url': LISTING.format('r/{}/'.format(subreddit) if subreddit else '', share),
+                'parser': ListingParser(share),
+                'max_bytes': MAX_BYTES,
+                'timeout': self.timeout,
+            }
+            for subreddit in subreddits
+        ]
+        d = webclient.shared().get_many(requests)
+        d.addCallback(lambda responses: [self.entry(response) for response in responses])
+        return d
+
+    def entry(self, response):
+        if isinstance(response, Exception):
+            return response
+        if response.code != 200:
+            return webclient.FetchError('HTTP {}'.format(response.code))
+        return fetch.Entry(json.dumps(response.parser.posts))
+
+
+_shared = None
+_shared_lock = threading.Lock()
+
+
+def shared():
+    global _shared
+    with _shared_lock:
+        if _shared is None:
+            _shared = RedditService(ttl=getattr(settings, 'reddit_ttl', 60))
+        return _shared
@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+"""Feed a capture (settings.capture_file) back through MinChat conversations.
+
+    python replay.py capture.jsonl --speed 10
+    python replay.py capture.jsonl --speed max --redis server --output replay.json
+
+Network commands (%url, %reddit, %weather) answer from local stubs.
+Replies are counted, not sent anywhere.
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import threading
+
+import bench
+import capture
+import loadtest
+
+
+class StubFetch(object):
+    def titles(self, urls, ttl=None):
+        return ['Stub title for {}'.format(url) for url in urls]
+
+    def stats(self):
+        return 'Fetch cache: stubbed for replay'
+
+
+class StubReddit(object):
+    def top(self, subreddits, limit=5):
+        import reddit
+        return [reddit.Post('Stub post {}'.format(i), 'http://localhost/{}'.format(i)) for i in xrange(limit)], []
+
+
+class StubWeather(object):
+    def lookup_many(self, locations):
+        import weather
+        return [
+            weather.parse(data={
+                'id': 0,
+                'name': location,
+                'weather': [{'description': 'stubbed'}],
+                'main': {'temp_min': 280.0, 'temp': 290.0, 'temp_max': 300.0},
+            })
+            for location in locations
+        ]
+
+
+def install_stubs():
+    import fetch
+    import reddit
+    import weather
+    fetch._shared = StubFetch()
+    reddit._shared = StubReddit()
+    weather._shared = StubWeather()
+
+
+class Replies(object):
+    def __init__(self, busy):
+        self.busy = busy
+        self.lines = 0
+        self.rejected = 0
+        self.lock = threading.Lock()
+
+    def sent(self, text):
+        with self.lock:
+            self.lines += 1
+            if text == self.busy:
+                self.rejected += 1
+
+
+def conversations(bot, replies):
+    class ReplayGroupConversation(bot.MinGroupConversation):
+        def sendText(self, text):
+            replies.sent(text)
+
+    class ReplayConversation(bot.MinConversation):
+        def sendText(self, text):
+            replies.sent(text)
+
+    return ReplayGroupConversation, ReplayConversation
+
+
+def run(options):
+    import settings
+    process = loadtest.setup_redis(options.redis, settings)
+    if not options.throttle:
+        settings.output_throttle = {None: {'burst': 10 ** 6, 'rate': 10 ** 6}}
+    # replaying must not capture itself
+    settings.capture_file = None
+    import bot
+    import logger
+    import storage
+    import executor
+    import scheduler
+    import botcommand
+    from twisted.internet import reactor, threads
+    install_stubs()
+
+    replies = Replies(botcommand.BotCommand.BUSY_MESSAGE)
+    group_class, private_class = conversations(bot, replies)
+    chatui = bot.MinChat()
+    groups = {}
+    people = {}
+    peak = {'threads': threading.active_count(), 'executor': 0, 'scheduler': 0}
+    round_trips_before = dict((name, list(value)) for name, value in storage.stats.items())
+
+    def group(name):
+        if name not in groups:
+            groups[name] = group_class(bench.FakeGroup(name), chatui)
+        return groups[name]
+
+    def person(nick):
+        if nick not in people:
+            people[nick] = private_class(loadtest.FakePerson(nick), chatui)
+        return people[nick]
+
+    def deliver(event):
+        kind, target, nick, text = event['kind'], event['target'], event['nick'], event.get('text', '')
+        if kind == 'pm':
+            person(nick).showMessage(text)
+        elif kind == 'msg':
+            group(target).showGroupMessage(nick, text)
+        elif kind == 'topic':
+            group(target).setTopic(text, nick)
+        elif kind == 'join':
+            group(target).memberJoined(nick)
+        elif kind == 'leave':
+            group(target).memberLeft(nick)
+        elif kind == 'nick' and target:
+            group(target).memberChangedNick(nick, text)
+        elif kind == 'nick':
+            conversation = person(nick)
+            conversation.contactChangedNick(conversation.person, text)
+            people[text] = people.pop(nick)
+
+    def sample():
+        while not done.is_set():
+            peak['threads'] = max(peak['threads'], threading.active_count())
+            peak['executor'] = max(peak['executor'], executor.shared().depth)
+            peak['scheduler'] = max(peak['scheduler'], scheduler.for_account(bench.FakeAccount.accountName).depth())
+            time.sleep(0.05)
+
+    bench.start_reactor()
+    done = threading.Event()
+    sampler = threading.Thread(target=sample)
+    sampler.daemon = True
+    sampler.start()
+
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    events = commands = 0
+    first = last = None
+    try:
+        started = time.time()
+        for event in capture.read(options.capture):
+            if first is None:
+                first = event['t']
+            last = event['t']
+            if options.speed != 'max':
+                delay = started + (event['t'] - first) / float(options.speed) - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+            reactor.callFromThread(deliver, event)
+            events += 1
+            if event['kind'] in ('pm', 'msg') and botcommand.is_command(event['text']):
+                commands += 1
+        feeding = time.time() - started
+        deadline = time.time() + options.drain
+
+        def busy():
+            # everything delivered so far has been handed to the executor once the reactor answers
+            threads.blockingCallFromThread(reactor, lambda: None)
+            work = executor.shared()
+            return work.depth or work.running or scheduler.for_account(bench.FakeAccount.accountName).depth()
+
+        while time.time() < deadline and busy():
+            time.sleep(0.05)
+        elapsed = time.time() - started
+        done.set()
+    finally:
+        # let the log writer finish with the stand-in stdout before it goes away
+        logger._writer.queue.join()
+        sys.stdout.close()
+        sys.stdout = stdout
+        if process is not None:
+            process.terminate()
+
+    round_trips = {}
+    for name, (requests, trips) in storage.stats.items():
+        before = round_trips_before.get(name, [0, 0])
+        if requests > before[0]:
+            round_trips[name] = round(float(trips - before[1]) / (requests - before[0]), 2)
+    return {
+        'commit': loadtest.commit(),
+        'capture': options.capture,
+        'speed': options.speed,
+        'captured_seconds': round((last - first) if events else 0, 3),
+        'replay_seconds': round(elapsed, 3),
+        'events': events,
+        'events_per_sec': round(events / feeding, 1) if feeding else None,
+        'commands': commands,
+        'reply_lines': replies.lines,
+        'rejected': replies.rejected,
+        'peak_executor_depth': peak['executor'],
+        'peak_scheduler_depth': peak['scheduler'],
+        'peak_threads': peak['threads'],
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'redis_round_trips_per_command': round_trips,
+    }
+
+
+def speed(value):
+    if value == 'max':
+        return value
+    if float(value) <= 0:
+        raise argparse.ArgumentTypeError('speed must be positive or max')
+    return float(value)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('capture', help='file written with settings.capture_file')
+    parser.add_argument('--speed', type=speed, default=1.0, help='1, 10, ... times real time, or max')
+    parser.add_argument('--redis', choices=('fake', 'server', 'settings'), default='fake',
+                        help='in-process stand-in, a throwaway local redis-server, or the one in settings')
+    parser.add_argument('--throttle', action='store_true', help='keep the configured flood control')
+    parser.add_argument('--drain', type=float, default=30, help='seconds to wait for queued work after the last event')
+    parser.add_argument('--output', default=None, help='write the JSON report here instead of stdout')
+    options = parser.parse_args()
+    report = json.dumps(run(options), indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as out:
+            out.write(report + '\n')
+    else:
+        print report
+    os._exit(0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,158 @@
+import os
+import sys
+import Queue
+import signal
+import psutil
+from twisted.internet import error, protocol, reactor
+
+# spawnProcess has no preexec hook, so the child makes itself a session and process group
+# leader before exec'ing the command; kill() then reaches everything it started
+SETSID = [sys.executable, '-c', 'import os, sys; os.setsid(); os.execvp(sys.argv[1], sys.argv[1:])']
+
+
+# a line without a newline is handed on in pieces this long, so nothing buffers more
+LINE_BYTES = 4096
+
+
+class StreamingProcess(protocol.ProcessProtocol):
+    """Hands complete lines of stdout and stderr to a Run as they arrive.
+
+    Every byte read counts against max_bytes, newline or not; the child is
+    killed as soon as it writes more.
+    """
+
+    def __init__(self, run):
+        self.run = run
+        # childFD -> pieces of the line still waiting for its newline, and their length
+        self.partial = {1: [], 2: []}
+        self.partial_size = {1: 0, 2: 0}
+        self.received = 0
+        self.killed = None
+        self.timer = None
+        self.group = None
+
+    def connectionMade(self):
+        # the pid outlives the transport's, which is cleared once the child is reaped
+        self.group = self.transport.pid
+        self.transport.closeStdin()
+        self.timer = reactor.callLater(self.run.timeout, self.kill, 'timed out after {}s'.format(self.run.timeout))
+
+    def childDataReceived(self, childFD, data):
+        if self.killed:
+            return
+        room = self.run.max_bytes - self.received
+        self.received += len(data)
+        over = len(data) > room
+        if over:
+            data = data[:room]
+        lines = self.split(childFD, data)
+        if over:
+            lines.extend(self.rest())
+        if lines:
+            self.run.queue.put(('output', '\n'.join(lines)))
+        if over:
+            self.kill('output limit of {} bytes reached'.format(self.run.max_bytes))
+
+    def split(self, childFD, data):
+        """The lines data completes, keeping the rest; joins each buffered line once."""
+        pieces = self.partial.setdefault(childFD, [])
+        size = self.partial_size.get(childFD, 0)
+        lines = data.split('\n')
+        if len(lines) > 1:
+            pieces.append(lines[0])
+            lines[0] = ''.join(pieces)
+            pieces = [lines.pop()]
+            size = len(pieces[0])
+        else:
+            pieces.append(data)
+            size += len(data)
+            lines = []
+        if size >= LINE_BYTES:
+            line = ''.join(pieces)
+            while len(line) >= LINE_BYTES:
+                lines.append(line[:LINE_BYTES])
+                line = line[LINE_BYTES:]
+            pieces = [line]
+            size = len(line)
+        self.partial[childFD] = pieces
+        self.partial_size[childFD] = size
+        return lines
+
+    def rest(self):
+        """Whatever is buffered without a newline, per fd, emptying the buffers."""
+        lines = [''.join(pieces) for fd, pieces in sorted(self.partial.items()) if self.partial_size.get(fd)]
+        self.partial = {}
+        self.partial_size = {}
+        return lines
+
+    def kill(self, why):
+        if self.killed:
+            return
+        self.killed = why
+        if self.group is not None:
+            try:
+                os.killpg(self.group, signal.SIGKILL)
+            except OSError:
+                pass
+        # stragglers that left the group; pid is None once the child is reaped, and
+        # psutil.Process(None) would be the bot itself
+        if self.transport.pid is not None:
+            try:
+                children = psutil.Process(self.transport.pid).children(recursive=True)
+            except psutil.NoSuchProcess:
+                children = []
+            for child in children:
+                try:
+                    child.kill()
+                except psutil.NoSuchProcess:
+                    pass
+            try:
+                self.transport.signalProcess('KILL')
+            except error.ProcessExitedAlready:
+                pass
+        # a grandchild may still hold the pipes; closing our ends lets processEnded fire
+        self.transport.loseConnection()
+
+    def processEnded(self, reason):
+        if self.timer is not None and self.timer.active():
+            self.timer.cancel()
+        if not self.killed:
+            lines = self.rest()
+            if lines:
+                self.run.queue.put(('output', '\n'.join(lines)))
+        if self.killed:
+            status = 'Command killed: {}.'.format(self.killed)
+        elif reason.check(error.ProcessDone):
+            status = None
+        else:
+            status = 'Command exited with status {}.'.format(reason.value.exitCode or reason.value.signal)
+        self.run.queue.put(('done', status))
+
+
+class Run(object):
+    """A child process started from a command thread; iterate it for output as it arrives.
+
+    status is set once iteration finishes: None for a clean exit, otherwise why not.
+    """
+
+    def __init__(self, args, max_bytes, timeout, env=None):
+        self.args = args
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self.queue = Queue.Queue()
+        self.status = None
+        reactor.callFromThread(self.spawn, env if env is not None else os.environ)
+
+    def spawn(self, env):
+        try:
+            reactor.spawnProcess(StreamingProcess(self), SETSID[0], SETSID + list(self.args), env=env)
+        except (OSError, error.ProcessExitedAlready) as e:
+            self.queue.put(('done', 'Could not start command: {}'.format(e)))
+
+    def __iter__(self):
+        while True:
+            kind, value = self.queue.get()
+            if kind == 'done':
+                self.status = value
+                return
+            yield value
@@ -0,0 +1,119 @@
+import time
+import logger
+import metrics
+import settings
+import threading
+import traceback
+import collections
+from twisted.internet import reactor
+
+
+class TokenBucket(object):
+    def __init__(self, burst, rate):
+        self.burst = float(burst)
+        self.rate = float(rate)
+        self.tokens = self.burst
+        self.stamp = time.time()
+
+    def refill(self):
+        now = time.time()
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def take(self):
+        self.refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def wait(self):
+        self.refill()
+        return max(0, (1 - self.tokens) / self.rate)
+
+
+class OutputScheduler(object):
+    """All sends for one account, paced by a token bucket and round-robin across targets.
+
+    Everything but enqueue/flush runs on the reactor thread.
+    """
+    MAX_PENDING = 500
+    TRUNCATED = '... output truncated'
+
+    def __init__(self, burst, rate):
+        self.bucket = TokenBucket(burst, rate)
+        self.pending = {}
+        self.ring = collections.deque()
+        self.call = None
+        # seconds from enqueue to send, per line
+        self.lag = metrics.Histogram()
+
+    def enqueue(self, key, output_function, lines):
+        reactor.callFromThread(self._enqueue, key, output_function, lines)
+
+    def flush(self, key):
+        reactor.callFromThread(self._flush, key)
+
+    def depth(self, key=None):
+        if key is None:
+            return sum(len(q) for q in self.pending.itervalues())
+        return len(self.pending.get(key, ()))
+
+    def _enqueue(self, key, output_function, lines):
+        queue = self.pending.get(key)
+        if queue is None:
+            queue = self.pending[key] = collections.deque()
+            self.ring.append(key)
+        now = time.time()
+        for line in lines:
+            if len(queue) >= self.MAX_PENDING:
+                # one marker however many more lines arrive while the queue is full
+                if queue[-1][1] is not self.TRUNCATED:
+                    queue.append((output_function, self.TRUNCATED, now))
+                break
+            queue.append((output_function, line, now))
+        self._schedule(0)
+
+    def _flush(self, key):
+        if self.pending.pop(key, None) is not None:
+            self.ring.remove(key)
+
+    def _schedule(self, delay):
+        if self.call is None and self.ring:
+            self.call = reactor.callLater(delay, self._pump)
+
+    def _pump(self):
+        self.call = None
+        while self.ring and self.bucket.take():
+            key = self.ring.popleft()
+            queue = self.pending[key]
+            output_function, line, enqueued = queue.popleft()
+            self.lag.observe(time.time() - enqueued)
+            if queue:
+                self.ring.append(key)
+            else:
+                del self.pending[key]
+            try:
+                output_function(line)
+            except Exception:
+                logger.log(
+                    ('-!- SEND FAILED -!- ', ': ', traceback.format_exc()),
+                    (settings.cd['e'], None, settings.cd['e']),
+                )
+        self._schedule(self.bucket.wait())
+
+
+_schedulers = {}
+_schedulers_lock = threading.Lock()
+
+
+def for_account(account_name):
+    with _schedulers_lock:
+        if account_name not in _schedulers:
+            limits = getattr(settings, 'output_throttle', {})
+            limits = limits.get(account_name, limits.get(None, {}))
+            _schedulers[account_name] = metrics.outputs[account_name] = OutputScheduler(
+                burst=limits.get('burst', 5),
+                rate=limits.get('rate', 1.0),
+            )
+        return _schedulers[account_name]
@@ -0,0 +1,109 @@
+import redis
+import metrics
+import settings
+import threading
+import contextlib
+import collections
+
+_local = threading.local()
+_stats_lock = threading.Lock()
+# command name -> [requests, round trips]
+stats = collections.defaultdict(lambda: [0, 0])
+
+
+class Request(object):
+    """Redis state for handling one message: round trip count and deferred writes."""
+
+    def __init__(self, name):
+        self.name = name
+        self.round_trips = 0
+        self.pipe = None
+
+    def pipeline(self):
+        if self.pipe is None:
+            self.pipe = client.pipeline(transaction=False)
+        return self.pipe
+
+    def flush(self):
+        if self.pipe is not None and self.pipe.command_stack:
+            self.pipe.execute()
+
+
+def current():
+    return getattr(_local, 'request', None)
+
+
+def count_round_trip():
+    request = current()
+    if request is not None:
+        request.round_trips += 1
+
+
+@contextlib.contextmanager
+def request(name):
+    req = _local.request = Request(name)
+    try:
+        yield req
+    finally:
+        try:
+            req.flush()
+        finally:
+            _local.request = None
+            with _stats_lock:
+                stats[name][0] += 1
+                stats[name][1] += req.round_trips
+
+
+@contextlib.contextmanager
+def deferred():
+    """Pipeline for writes nobody reads the result of.
+
+    Inside a request they go out with the request's final flush, otherwise
+    as soon as the block exits.
+    """
+    req = current()
+    if req is not None:
+        yield req.pipeline()
+        return
+    pipe = client.pipeline(transaction=False)
+    yield pipe
+    pipe.execute()
+
+
+class Pipeline(redis.client.Pipeline):
+    def execute(self, raise_on_error=True):
+        if not self.command_stack:
+            return super(Pipeline, self).execute(raise_on_error)
+        count_round_trip()
+        with metrics.timed('redis'):
+            return super(Pipeline, self).execute(raise_on_error)
+
+
+class Redis(redis.Redis):
+    def execute_command(self, *args, **options):
+        count_round_trip()
+        with metrics.timed('redis'):
+            return super(Redis, self).execute_command(*args, **options)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return Pipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+
+pool = redis.BlockingConnectionPool(
+    host=getattr(settings, 'redis_host', 'localhost'),
+    port=getattr(settings, 'redis_port', 6379),
+    db=getattr(settings, 'redis_db', 0),
+    password=getattr(settings, 'redis_password', None),
+    socket_timeout=getattr(settings, 'redis_socket_timeout', 5),
+    max_connections=getattr(settings, 'redis_max_connections', 32),
+    timeout=getattr(settings, 'redis_pool_timeout', 5),
+)
+client = Redis(connection_pool=pool)
+
+
+def pubsub():
+    # subscribers sit idle for long stretches, so they get their own pool without a socket timeout
+    kwargs = dict(pool.connection_kwargs)
+    if 'socket_timeout' in kwargs:
+        kwargs['socket_timeout'] = None
+    return redis.Redis(connection_pool=redis.ConnectionPool(connection_class=pool.connection_class, **kwargs)).pubsub()
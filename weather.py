@@ -0,0 +1,189 @@
+import json
+import time
+import fetch
+import urllib
+import metrics
+import settings
+import threading
+import webclient
+import collections
+from twisted.internet import reactor, task, threads
+
+API = 'http://api.openweathermap.org/data/2.5/{}?{}'
+GROUP_LIMIT = 20
+
+
+class WeatherError(Exception):
+    def __init__(self, raw):
+        Exception.__init__(self, raw)
+        self.raw = raw
+
+
+class Conditions(object):
+    def __init__(self, data, raw=None):
+        self.raw = raw if raw is not None else json.dumps(data)
+        self.city_id = data['id']
+        self.name = data['name'].encode('utf-8')
+        self.description = data['weather'][0]['description'].encode('utf-8')
+        self.temp_min = data['main']['temp_min']
+        self.temp = data['main']['temp']
+        self.temp_max = data['main']['temp_max']
+
+
+def normalize(location):
+    """Canonical cache key: 'zip:92618' or 'q:irvine,ca,us'."""
+    location = location.strip().lower()
+    if location.isdigit():
+        return 'zip:{}'.format(location)
+    parts = [part.strip() for part in location.split(',')]
+    if len(parts) < 3:
+        parts = (parts + [''])[:2] + ['us']
+    return 'q:{}'.format(','.join(part for part in parts[:3] if part))
+
+
+def parse(raw=None, data=None):
+    try:
+        if data is None:
+            data = json.loads(raw)
+        return Conditions(data, raw)
+    except (KeyError, IndexError, TypeError, ValueError):
+        return WeatherError(raw if raw is not None else json.dumps(data))
+
+
+class WeatherService(object):
+    """Conditions per location, in the shared fetch cache, refreshed ahead of expiry while popular.
+
+    Locations whose city id is known are fetched through the group endpoint.
+    """
+
+    def __init__(self, ttl=600, refresh_interval=60, popular_hits=3, appid=None):
+        self.ttl = ttl
+        self.refresh_interval = refresh_interval
+        self.popular_hits = popular_hits
+        self.appid = appid
+        self.lock = threading.Lock()
+        self.city_ids = {}
+        self.hits = collections.Counter()
+        self.refresher = None
+
+    def url(self, endpoint, **params):
+        if self.appid:
+            params['appid'] = self.appid
+        return API.format(endpoint, urllib.urlencode(sorted(params.items())))
+
+    def lookup_many(self, locations):
+        """Conditions, WeatherError or FetchError per location, in order. Command threads only."""
+        keys = [normalize(location) for location in locations]
+        with self.lock:
+            for key in keys:
+                self.hits[key] += 1
+        results = fetch.shared().cached_many(['weather:{}'.format(key) for key in keys], self.ttl, self.load)
+        if self.refresher is None:
+            reactor.callFromThread(self.start_refresh)
+        return [result if isinstance(result, Exception) else parse(raw=result) for result in results]
+
+    def load(self, items):
+        keys = [key[len('weather:'):] for key, _ in items]
+        with metrics.timed('http'):
+            fetched = threads.blockingCallFromThread(reactor, self.fetch, keys)
+        return [entry(fetched[key]) for key in keys]
+
+    def fetch(self, keys):
+        """Deferred {key: result}; one group request per GROUP_LIMIT known ids. Reactor only."""
+        with self.lock:
+            known = [key for key in keys if key in self.city_ids]
+        unknown = [key for key in keys if key not in known]
+        requests = []
+        batches = []
+        for start in xrange(0, len(known), GROUP_LIMIT):
+            batch = known[start:start + GROUP_LIMIT]
+            ids = ','.join(str(self.city_ids[key]) for key in batch)
+            requests.append({'url': self.url('group', id=ids)})
+            batches.append(batch)
+        for key in unknown:
+            param, value = key.split(':', 1)
+            requests.append({'url': self.url('weather', **{param: value})})
+            batches.append(None)
+        d = webclient.shared().get_many(requests)
+        d.addCallback(self.collect, batches, unknown)
+        return d
+
+    def collect(self, responses, batches, unknown):
+        results = {}
+        unknown = iter(unknown)
+        for batch, response in zip(batches, responses):
+            if batch is None:
+                key = next(unknown)
+                results[key] = response if isinstance(response, Exception) else parse(raw=response.body)
+                continue
+            if isinstance(response, Exception):
+                results.update((key, response) for key in batch)
+                continue
+            try:
+                by_id = dict((item['id'], item) for item in json.loads(response.body)['list'])
+            except (KeyError, TypeError, ValueError):
+                by_id = {}
+            for key in batch:
+                item = by_id.get(self.city_ids[key])
+                results[key] = parse(data=item) if item else WeatherError(response.body)
+        with self.lock:
+            for key, result in results.iteritems():
+                if isinstance(result, Conditions):
+                    self.city_ids[key] = result.city_id
+        return results
+
+    def start_refresh(self):
+        if self.refresher is None:
+            self.refresher = task.LoopingCall(self.refresh_later)
+            self.refresher.start(self.refresh_interval, now=False)
+
+    def refresh_later(self):
+        # the cache may go to redis, which the reactor must not wait for
+        d = threads.deferToThread(self.refresh)
+        # a failed refresh must not stop the LoopingCall
+        d.addErrback(lambda failure: None)
+        return d
+
+    def refresh(self):
+        """Fetch popular locations again before their entries expire. Thread pool only."""
+        now = time.time()
+        with self.lock:
+            popular = [key for key, hits in self.hits.iteritems() if hits >= self.popular_hits]
+            # popularity decays so yesterday's favourites stop being refreshed
+            for key in self.hits.keys():
+                self.hits[key] //= 2
+                if not self.hits[key]:
+                    del self.hits[key]
+        cache = fetch.shared()
+        due = []
+        for key in popular:
+            cached = cache.lookup('weather:{}'.format(key))
+            if cached is not None and now - cached.fetched > self.ttl - self.refresh_interval * 1.5:
+                due.append(key)
+        if due:
+            fetched = threads.blockingCallFromThread(reactor, self.fetch, due)
+            for key, result in fetched.iteritems():
+                if isinstance(result, Conditions):
+                    cache.store('weather:{}'.format(key), entry(result))
+
+
+def entry(result):
+    """fetch.Entry holding the raw json of Conditions; errors are passed on, uncached."""
+    return fetch.Entry(result.raw) if isinstance(result, Conditions) else result
+
+
+_shared = None
+_shared_lock = threading.Lock()
+
+
+def shared():
+    global _shared
+    with _shared_lock:
+        if _shared is None:
+            _shared = WeatherService(
+                ttl=getattr(settings, 'weather_ttl', 600),
+                refresh_interval=getattr(settings, 'weather_refresh_interval', 60),
+                popular_hits=getattr(settings, 'weather_popular_hits', 3),
+                appid=getattr(settings, 'openweathermap_appid', None),
+            )
+        return _shared
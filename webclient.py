@@ -0,0 +1,199 @@
+import logger
+import socket
+import urllib2
+import metrics
+import urlparse
+import settings
+from twisted.internet import defer, protocol, reactor, threads
+from twisted.web.client import Agent, HTTPConnectionPool, RedirectAgent, ResponseDone, PotentialDataLoss
+from twisted.web.http_headers import Headers
+
+MAX_SIZE = 2097152 * 10
+USER_AGENT = 'zonkb0t'
+READ_SIZE = 65536
+
+# Agent speaks TLS only with pyOpenSSL and service_identity installed; without them
+# https goes through urllib2 and the stdlib ssl module on the reactor's thread pool
+try:
+    import OpenSSL
+    import service_identity
+    TLS = True
+except ImportError:
+    TLS = False
+
+
+class FetchError(Exception):
+    pass
+
+
+class Response(object):
+    def __init__(self, url, code, headers, body, length=None, parser=None):
+        self.url = url
+        self.code = code
+        self.headers = headers
+        self.body = body
+        self.length = length
+        self.parser = parser
+
+    def header(self, name, default=None):
+        values = self.headers.getRawHeaders(name)
+        return values[0] if values else default
+
+
+class BodyReader(protocol.Protocol):
+    """Collect a body up to max_bytes, or until parser says it has seen enough."""
+
+    def __init__(self, finished, max_bytes, parser=None):
+        self.finished = finished
+        self.max_bytes = max_bytes
+        self.parser = parser
+        self.chunks = []
+        self.read = 0
+
+    def dataReceived(self, data):
+        if self.finished.called:
+            return
+        data = data[:self.max_bytes - self.read]
+        self.read += len(data)
+        if self.parser is not None:
+            self.parser.feed(data)
+        else:
+            self.chunks.append(data)
+        if self.read >= self.max_bytes or (self.parser is not None and self.parser.done):
+            self.finish()
+            self.transport.stopProducing()
+
+    def connectionLost(self, reason):
+        if self.finished.called:
+            return
+        if reason.check(ResponseDone, PotentialDataLoss):
+            self.finish()
+        else:
+            self.finished.errback(reason)
+
+    def finish(self):
+        self.finished.callback(''.join(self.chunks))
+
+    def abort(self):
+        self.transport.stopProducing()
+
+
+class Client(object):
+    """Agent over a persistent pool, with a concurrency limit per host."""
+
+    def __init__(self, per_host=4, persistent_per_host=2, connect_timeout=5, timeout=10):
+        self.pool = HTTPConnectionPool(reactor, persistent=True)
+        self.pool.maxPersistentPerHost = persistent_per_host
+        self.agent = RedirectAgent(Agent(reactor, connectTimeout=connect_timeout, pool=self.pool))
+        self.per_host = per_host
+        self.timeout = timeout
+        self.hosts = {}
+
+    def semaphore(self, url):
+        host = urlparse.urlsplit(url).netloc
+        if host not in self.hosts:
+            self.hosts[host] = defer.DeferredSemaphore(self.per_host)
+        return self.hosts[host]
+
+    def get(self, url, headers=(), max_bytes=MAX_SIZE, parser=None, timeout=None):
+        """Deferred Response; fails with FetchError. Reactor thread only."""
+        d = self.semaphore(url).run(self._get, url, headers, max_bytes, parser)
+        d.addTimeout(timeout or self.timeout, reactor)
+        d.addErrback(self._error, url)
+        return d
+
+    def _error(self, failure, url):
+        if failure.check(FetchError):
+            return failure
+        raise FetchError('{}: {}'.format(url, failure.getErrorMessage() or failure.type.__name__))
+
+    def _get(self, url, headers, max_bytes, parser):
+        if not TLS and url.lower().startswith('https://'):
+            return threads.deferToThread(self._get_blocking, url, headers, max_bytes, parser)
+        raw_headers = Headers({'User-Agent': [USER_AGENT]})
+        for name, value in headers:
+            raw_headers.addRawHeader(name, value)
+        d = self.agent.request('GET', url, raw_headers)
+        d.addCallback(self._read, url, max_bytes, parser)
+        return d
+
+    def _read(self, response, url, max_bytes, parser):
+        content_type = (response.headers.getRawHeaders('content-type') or [''])[0]
+        if response.code == 304 or (parser is not None and not parser.accepts(content_type)):
+            max_bytes = 0
+        reader = []
+        finished = defer.Deferred(lambda d: reader[0].abort())
+        reader.append(BodyReader(finished, max_bytes, parser))
+        response.deliverBody(reader[0])
+        length = response.length if isinstance(response.length, (int, long)) else None
+        finished.addCallback(lambda body: Response(url, response.code, response.headers, body, length, parser))
+        return finished
+
+    def _get_blocking(self, url, headers, max_bytes, parser):
+        request = urllib2.Request(url, headers=dict([('User-Agent', USER_AGENT)] + list(headers)))
+        try:
+            response = urllib2.urlopen(request, timeout=self.timeout)
+        except urllib2.HTTPError as e:
+            # 304 and error statuses still carry a code and headers worth returning
+            response = e
+        except (urllib2.URLError, socket.error, ValueError) as e:
+            raise FetchError('{}: {}'.format(url, getattr(e, 'reason', e)))
+        try:
+            raw_headers = Headers()
+            for line in response.info().headers:
+                name, _, value = line.partition(':')
+                raw_headers.addRawHeader(name.strip(), value.strip())
+            content_type = response.info().getheader('content-type', '')
+            if response.code == 304 or (parser is not None and not parser.accepts(content_type)):
+                max_bytes = 0
+            chunks = []
+            read = 0
+            while read < max_bytes and not (parser is not None and parser.done):
+                data = response.read(min(READ_SIZE, max_bytes - read))
+                if not data:
+                    break
+                read += len(data)
+                if parser is not None:
+                    parser.feed(data)
+                else:
+                    chunks.append(data)
+            length = response.info().getheader('content-length')
+            return Response(response.geturl(), response.code, raw_headers, ''.join(chunks),
+                            int(length) if length and length.isdigit() else None, parser)
+        except (socket.error, IOError) as e:
+            raise FetchError('{}: {}'.format(url, e))
+        finally:
+            response.close()
+
+    def get_many(self, requests):
+        """Deferred list of Response or FetchError, in the order of requests."""
+        deferreds = [self.get(**request) for request in requests]
+        d = defer.DeferredList(deferreds, consumeErrors=True)
+        d.addCallback(lambda results: [value if ok else value.value for ok, value in results])
+        return d
+
+
+_shared = None
+
+
+def shared():
+    global _shared
+    if _shared is None:
+        if not TLS:
+            logger.log(
+                ('-!- NO pyOpenSSL/service_identity -!- ', ': ', 'https is fetched with urllib2 on worker threads'),
+                (settings.cd['e'], None, settings.cd['e']),
+            )
+        _shared = Client(
+            per_host=getattr(settings, 'http_per_host', 4),
+            persistent_per_host=getattr(settings, 'http_persistent_per_host', 2),
+            connect_timeout=getattr(settings, 'http_connect_timeout', 5),
+            timeout=getattr(settings, 'http_timeout', 10),
+        )
+    return _shared
+
+
+def fetch_many(requests):
+    """get_many for command threads: blocks on the reactor and returns the list."""
+    with metrics.timed('http'):
+        return threads.blockingCallFromThread(reactor, lambda: shared().get_many(requests))